@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+
+# Benchmarks for gfwmass.py. Every case runs in a freshly spawned process so
+# the reported peak RSS belongs to that case alone. Cloudflare cases run
+# against mock_cloudflare.py in its own process.
+
+import base64
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import List, Dict, Any, Callable, Iterable, Iterator
+import argparse
+
+from gfwmass import GFWMass, User, percentile
+
+MOCK_CLOUDFLARE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_cloudflare.py')
+
+TIERS = [100, 1000, 10000, 100000]
+
+# Largest default tier per case, where the top tier would be impractical:
+# 100k users x 1,000 domains writes about 23 GB. An explicit --sizes wins.
+MAX_TIER = {'user-subscriptions': 10000}
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def make_gfw(workdir: str, domain: str = 'example.com') -> GFWMass:
+    config: Dict[str, Any] = {
+        'domain': domain,
+        'origin_ip': '127.0.0.1',
+        'user_id': '00000000-0000-4000-8000-000000000000',
+        'cloudflare': {'api_token': 'benchmark', 'zone_id': 'benchmark'},
+        # Cases that want record ids from the state database opt in
+        'state_db': None,
+    }
+    path = os.path.join(workdir, 'config.json')
+    with open(path, 'w') as f:
+        json.dump(config, f)
+    return GFWMass(path)
+
+
+def synthetic_domains(size: int, domain: str = 'example.com') -> Iterable[str]:
+    return (f"node-{i:07d}.{domain}" for i in range(size))
+
+
+@contextlib.contextmanager
+def quiet() -> Iterator[None]:
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def generate(gfw: GFWMass, size: int, options: Dict[str, Any]):
+    gfw.generate_subdomains(size)
+
+
+def save_configs(gfw: GFWMass, size: int, options: Dict[str, Any]):
+    gfw.domains = list(synthetic_domains(size))
+    with quiet():
+        gfw.save_configs()
+
+
+def save_configs_noop(gfw: GFWMass, size: int, options: Dict[str, Any]):
+    # A rebuild with nothing changed: every output is hashed, none rewritten
+    gfw.domains = list(synthetic_domains(size))
+    with quiet():
+        gfw.save_configs()
+        gfw.artifact_store = None
+        started = time.perf_counter()
+        gfw.save_configs()
+        seconds = time.perf_counter() - started
+    return {'seconds': seconds, 'rewritten': len(gfw.artifacts().changed)}
+
+
+def render_subscription(gfw: GFWMass, size: int, options: Dict[str, Any]):
+    gfw.domains = list(synthetic_domains(size))
+    gfw.generate_subscription()
+
+
+def legacy_subscription(gfw: GFWMass, size: int, options: Dict[str, Any]):
+    # save_configs before the streaming writer: list of links, joined,
+    # encoded, written, then decoded again for the plain file
+    gfw.domains = list(synthetic_domains(size))
+    user_id = gfw.config['user_id']
+    links = []
+    for domain in gfw.domains:
+        links.append(
+            f"vless://{user_id}@{domain}:443?encryption=none&security=tls"
+            f"&type=ws&host={domain}&path=/ws#{domain}"
+        )
+    encoded = base64.b64encode('\n'.join(links).encode()).decode()
+    with open('subscription.txt', 'w') as f:
+        f.write(encoded)
+    with open('subscription_decoded.txt', 'w') as f:
+        f.write(base64.b64decode(encoded).decode())
+
+
+def stream_subscription(gfw: GFWMass, size: int, options: Dict[str, Any]):
+    gfw.write_subscription(synthetic_domains(size))
+
+
+def user_subscriptions(gfw: GFWMass, size: int, options: Dict[str, Any]):
+    # size users x 1000 domains, then one more user: only that file renders
+    gfw.domains = list(synthetic_domains(1000))
+    users = [User(f"user{i}@example.com", str(uuid.UUID(int=i))) for i in range(size)]
+    started = time.perf_counter()
+    gfw.write_user_subscriptions(users)
+    seconds = time.perf_counter() - started
+    users.append(User("late@example.com", str(uuid.UUID(int=size))))
+    incremental = time.perf_counter()
+    rendered, _ = gfw.write_user_subscriptions(users)
+    return {'seconds': seconds, 'add_one_ms': (time.perf_counter() - incremental) * 1000,
+            'add_one_rendered': rendered}
+
+
+def transport_listener(kind: str, workdir: str):
+    if kind == 'unix':
+        address = os.path.join(workdir, 'xray.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(address)
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        address = listener.getsockname()
+    listener.listen(1024)
+    return listener, address
+
+
+def transport_connect(kind: str) -> Callable[[GFWMass, int, Dict[str, Any]], Dict[str, Any]]:
+    # size = connections opened and accepted, the Caddy -> Xray setup cost
+    def run(gfw: GFWMass, size: int, options: Dict[str, Any]) -> Dict[str, Any]:
+        listener, address = transport_listener(kind, os.getcwd())
+
+        def serve():
+            for _ in range(size):
+                conn, _ = listener.accept()
+                conn.close()
+
+        server = threading.Thread(target=serve)
+        server.start()
+        for _ in range(size):
+            client = socket.socket(listener.family, socket.SOCK_STREAM)
+            client.connect(address)
+            if kind == 'tcp':
+                # Close with RST so TIME_WAIT does not exhaust ephemeral ports
+                # at large sizes; that cost is what the unix socket avoids anyway
+                client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            client.close()
+        server.join()
+        listener.close()
+        return {}
+    return run
+
+
+def transport_stream(kind: str) -> Callable[[GFWMass, int, Dict[str, Any]], Dict[str, Any]]:
+    # size = KiB pushed through one connection in 64 KiB writes
+    def run(gfw: GFWMass, size: int, options: Dict[str, Any]) -> Dict[str, Any]:
+        listener, address = transport_listener(kind, os.getcwd())
+        received = [0]
+
+        def serve():
+            conn, _ = listener.accept()
+            buffer = bytearray(1 << 16)
+            while True:
+                n = conn.recv_into(buffer)
+                if not n:
+                    break
+                received[0] += n
+            conn.close()
+
+        server = threading.Thread(target=serve)
+        server.start()
+        client = socket.socket(listener.family, socket.SOCK_STREAM)
+        client.connect(address)
+        started = time.perf_counter()
+        chunk = b'\0' * (1 << 16)
+        remaining = size * 1024
+        while remaining > 0:
+            client.sendall(chunk[:remaining])
+            remaining -= len(chunk)
+        client.close()
+        server.join()
+        elapsed = time.perf_counter() - started
+        listener.close()
+        return {'mib_per_second': received[0] / (1 << 20) / elapsed if elapsed > 0 else 0.0}
+    return run
+
+
+@contextlib.contextmanager
+def mock_cloudflare(options: Dict[str, Any]) -> Iterator[str]:
+    process = subprocess.Popen(
+        [sys.executable, MOCK_CLOUDFLARE, '--port', '0',
+         '--latency', str(options['latency']),
+         '--error-rate', str(options['error_rate']),
+         '--retry-after', str(options['retry_after']),
+         '--seed', '1'],
+        stdout=subprocess.PIPE, text=True)
+    try:
+        yield process.stdout.readline().rsplit(' ', 1)[-1].strip()
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def attach_cloudflare(gfw: GFWMass, api_base: str, options: Dict[str, Any]):
+    gfw.config['cloudflare'].update({
+        'api_base': api_base,
+        'workers': options['workers'],
+        'rate_limit': options['rate_limit'],
+        'burst': max(1, options['workers']),
+        'batch': options['batch_size'] > 1,
+        'batch_size': options['batch_size'],
+    })
+
+
+def record_api_calls(gfw: GFWMass) -> List[Any]:
+    # Time every HTTP attempt (retries included) via a requests response hook
+    calls: List[Any] = []
+    factory = gfw.cloudflare_client
+
+    def instrumented(*args, **kwargs):
+        client = factory(*args, **kwargs)
+        client.session.hooks['response'].append(
+            lambda response, *args, **kwargs: calls.append(
+                (response.elapsed.total_seconds() * 1000, response.status_code)))
+        return client
+
+    gfw.cloudflare_client = instrumented
+    return calls
+
+
+def api_stats(calls: List[Any], seconds: float) -> Dict[str, Any]:
+    latencies = [latency for latency, _ in calls]
+    return {
+        'seconds': seconds,
+        'api_calls': len(calls),
+        'api_rate_limited': sum(1 for _, status in calls if status == 429),
+        'api_p50_ms': percentile(latencies, 50),
+        'api_p99_ms': percentile(latencies, 99),
+    }
+
+
+def cloudflare_add(gfw: GFWMass, size: int, options: Dict[str, Any]) -> Dict[str, Any]:
+    with mock_cloudflare(options) as api_base:
+        attach_cloudflare(gfw, api_base, options)
+        gfw.domains = list(synthetic_domains(size))
+        calls = record_api_calls(gfw)
+        started = time.perf_counter()
+        with quiet():
+            gfw.add_cloudflare_records()
+        return api_stats(calls, time.perf_counter() - started)
+
+
+def cloudflare_remove(gfw: GFWMass, size: int, options: Dict[str, Any]) -> Dict[str, Any]:
+    with mock_cloudflare(options) as api_base:
+        attach_cloudflare(gfw, api_base, options)
+        gfw.domains = list(synthetic_domains(size))
+        with quiet():
+            gfw.add_cloudflare_records()
+        calls = record_api_calls(gfw)
+        started = time.perf_counter()
+        with quiet():
+            gfw.remove_cloudflare_records(gfw.domains)
+        return api_stats(calls, time.perf_counter() - started)
+
+
+def cloudflare_remove_stored(gfw: GFWMass, size: int, options: Dict[str, Any]) -> Dict[str, Any]:
+    # Record ids kept by the add in the state database: no zone listing
+    gfw.config['state_db'] = 'gfwmass.db'
+    return cloudflare_remove(gfw, size, options)
+
+
+CASES: Dict[str, Callable[[GFWMass, int, Dict[str, Any]], Any]] = {
+    'generate': generate,
+    'save-configs': save_configs,
+    'save-configs-noop': save_configs_noop,
+    'subscription-render': render_subscription,
+    'subscription-legacy': legacy_subscription,
+    'subscription-stream': stream_subscription,
+    'user-subscriptions': user_subscriptions,
+    'cloudflare-add': cloudflare_add,
+    'cloudflare-remove': cloudflare_remove,
+    'cloudflare-remove-stored': cloudflare_remove_stored,
+    'transport-connect-tcp': transport_connect('tcp'),
+    'transport-connect-unix': transport_connect('unix'),
+    'transport-stream-tcp': transport_stream('tcp'),
+    'transport-stream-unix': transport_stream('unix'),
+}
+
+
+BASE_FIELDS = ('case', 'size', 'seconds', 'ops_per_second', 'peak_rss_mb', 'baseline_rss_mb')
+
+
+def run_case(name: str, size: int, options: Dict[str, Any], queue):
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        gfw = make_gfw(workdir)
+        baseline = peak_rss_mb()
+        started = time.perf_counter()
+        extra = CASES[name](gfw, size, options) or {}
+        elapsed = time.perf_counter() - started
+        result = {
+            'case': name,
+            'size': size,
+            'seconds': elapsed,
+            'peak_rss_mb': peak_rss_mb(),
+            'baseline_rss_mb': baseline,
+        }
+        # Cases with setup (e.g. populating the mock zone) report their own timing
+        result.update(extra)
+        result['ops_per_second'] = size / result['seconds'] if result['seconds'] > 0 else 0.0
+        queue.put(result)
+
+
+def run_isolated(name: str, size: int, options: Dict[str, Any]) -> Dict[str, Any]:
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_case, args=(name, size, options, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(MOCK_CLOUDFLARE)).stdout.strip()
+    except OSError:
+        return ''
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str):
+    with open(baseline_path, 'r') as f:
+        baseline = {(r['case'], r['size']): r for r in json.load(f)['results']}
+
+    print(f"\nCompared with {baseline_path}:")
+    print(f"{'case':<24} {'size':>9} {'ops/s':>10} {'peak MB':>10}")
+    for result in results:
+        before = baseline.get((result['case'], result['size']))
+        if before is None:
+            continue
+        speed = (result['ops_per_second'] / before['ops_per_second'] - 1) * 100 if before['ops_per_second'] else 0.0
+        memory = result['peak_rss_mb'] - before['peak_rss_mb']
+        print(f"{result['case']:<24} {result['size']:>9} {speed:>+9.1f}% {memory:>+9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GFWMass benchmarks')
+    parser.add_argument('cases', nargs='*', default=list(CASES),
+                        help=f"Cases to run (default: all). Available: {', '.join(CASES)}")
+    parser.add_argument('--sizes',
+                        help='Comma-separated sizes: endpoints, users (user-subscriptions), connections '
+                             '(transport-connect-*) or KiB (transport-stream-*) '
+                             f"(default: {','.join(str(tier) for tier in TIERS)}; "
+                             f"user-subscriptions up to {MAX_TIER['user-subscriptions']})")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Mock Cloudflare: seconds of latency per request (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Mock Cloudflare: fraction of requests answered with 429 (default: 0)')
+    parser.add_argument('--retry-after', type=float, default=0.1,
+                        help='Mock Cloudflare: Retry-After seconds on 429 (default: 0.1)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Cloudflare client workers (default: 8)')
+    parser.add_argument('--rate-limit', type=float, default=1e6,
+                        help='Cloudflare client requests/s budget (default: unlimited; the real API allows 4)')
+    parser.add_argument('--batch-size', type=int, default=200,
+                        help='Cloudflare batch size, 1 for per-record calls (default: 200)')
+    parser.add_argument('-o', '--output', help='Write results as JSON to this file')
+    parser.add_argument('--compare', metavar='FILE', help='Compare against results saved with -o')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.cases if name not in CASES]
+    if unknown:
+        parser.error(f"unknown case(s): {', '.join(unknown)}")
+    sizes = [int(size) for size in args.sizes.split(',') if size] if args.sizes else TIERS
+    options = {
+        'latency': args.latency,
+        'error_rate': args.error_rate,
+        'retry_after': args.retry_after,
+        'workers': args.workers,
+        'rate_limit': args.rate_limit,
+        'batch_size': args.batch_size,
+    }
+
+    results: List[Dict[str, Any]] = []
+    print(f"{'case':<24} {'size':>9} {'seconds':>9} {'ops/s':>12} {'peak MB':>9} {'delta MB':>9}  extra")
+    for size in sizes:
+        for name in args.cases:
+            if not args.sizes and size > MAX_TIER.get(name, size):
+                continue
+            result = run_isolated(name, size, options)
+            results.append(result)
+            extra = ' '.join(f"{key}={value:.1f}" for key, value in result.items() if key not in BASE_FIELDS)
+            print(f"{name:<24} {size:>9} {result['seconds']:>9.3f} {result['ops_per_second']:>12.0f} "
+                  f"{result['peak_rss_mb']:>9.1f} {result['peak_rss_mb'] - result['baseline_rss_mb']:>9.1f}  {extra}")
+
+    if args.output:
+        report = {
+            'meta': {
+                'timestamp': int(time.time()),
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'options': options,
+            },
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# Checks the rotation daemon's hourly request budget against
+# mock_cloudflare.py. A ManualClock drives the cycles, so an hour of
+# rotations takes seconds: a cycle that would overspend is shrunk and then
+# skipped, spending resumes once the hour rolls over, and a restarted
+# daemon still counts what it spent before. Exits 1 if any check fails.
+#
+#   python3 check_rotation.py
+#   python3 check_rotation.py --domains 200 --batch 20 --batch-size 4 --budget 30
+
+import contextlib
+import json
+import os
+import sys
+import tempfile
+from typing import List, Dict, Any, Iterator
+import argparse
+
+from gfwmass import GFWMass, ManualClock, RotationDaemon, RotationResult
+from mock_cloudflare import MockCloudflare
+
+# A fixed, realistic epoch so logged timestamps format normally
+START = 1_700_000_000.0
+
+
+@contextlib.contextmanager
+def quiet() -> Iterator[None]:
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+class Checker:
+
+    def __init__(self):
+        self.failures = 0
+
+    def check(self, ok: bool, message: str):
+        print(f"{'ok  ' if ok else 'FAIL'}  {message}")
+        if not ok:
+            self.failures += 1
+
+
+def write_config(api_base: str, args: argparse.Namespace):
+    config: Dict[str, Any] = {
+        'domain': 'example.com',
+        'origin_ip': '127.0.0.1',
+        'user_id': '00000000-0000-4000-8000-000000000000',
+        'seed': 1,
+        'cloudflare': {
+            'api_token': 'check',
+            'zone_id': 'check',
+            'api_base': api_base,
+            'batch_size': args.batch_size,
+        },
+        'rotation': {'interval': args.interval, 'batch': args.batch, 'hourly_budget': args.budget},
+    }
+    with open('config.json', 'w') as f:
+        json.dump(config, f)
+
+
+def cycle(daemon: RotationDaemon, mock: MockCloudflare) -> RotationResult:
+    # Requests as counted by the mock, so the budget is checked against
+    # what Cloudflare saw rather than what the daemon thinks it spent
+    before = mock.state.request_count
+    with quiet():
+        result = daemon.rotate_once()
+    result = result._replace(requests=mock.state.request_count - before)
+    daemon.clock.advance(daemon.interval)
+    return result
+
+
+def restart(clock: ManualClock) -> RotationDaemon:
+    with quiet():
+        daemon = RotationDaemon(GFWMass(), clock)
+        daemon.recover()
+    return daemon
+
+
+def run_checks(mock: MockCloudflare, args: argparse.Namespace, checker: Checker):
+    with quiet():
+        gfw = GFWMass()
+        gfw.generate_subdomains(args.domains)
+        gfw.save_configs()
+        gfw.add_cloudflare_records()
+
+    clock = ManualClock(START)
+    daemon = restart(clock)
+    limit = daemon.budget.limit
+
+    # Budget exhaustion: full cycles, then a shrunk one, then nothing
+    results: List[RotationResult] = []
+    while len(results) < limit + 2:
+        results.append(cycle(daemon, mock))
+        if not results[-1].retired:
+            break
+    spent = sum(result.requests for result in results)
+    print(f"\n{len(results)} cycles: retired per cycle {[len(result.retired) for result in results]}, "
+          f"{spent} requests\n")
+    checker.check(bool(results[0].retired), "the first cycle rotates")
+    checker.check(spent <= limit, f"requests within the hour ({spent}) stay within the budget ({limit})")
+    checker.check(not results[-1].retired and results[-1].requests == 0,
+                  "an exhausted budget skips the cycle without calling Cloudflare")
+    checker.check(daemon.budget.remaining() == limit - spent, "the daemon counts every request it made")
+    checker.check(all(result.requests <= limit - sum(r.requests for r in results[:i])
+                      for i, result in enumerate(results)),
+                  "no cycle spends more than what was left")
+
+    # Restart: the spent budget comes back from the state database
+    refill = daemon.budget.refill_at()
+    daemon.close()
+    daemon = restart(clock)
+    checker.check(daemon.budget.remaining() == limit - spent,
+                  f"a restarted daemon still has {limit - spent} requests left, not {limit}")
+    result = cycle(daemon, mock)
+    checker.check(not result.retired and result.requests == 0, "a restarted daemon does not overspend")
+
+    # Roll-over: nothing until the first spend leaves the window
+    checker.check(refill is not None and refill <= START + 3600,
+                  "the budget refills an hour after the first rotation")
+    if refill is not None:
+        clock.now = refill - 1
+        result = cycle(daemon, mock)
+        checker.check(not result.retired, "nothing rotates a second before the hour is up")
+        clock.now = refill
+        result = cycle(daemon, mock)
+        checker.check(bool(result.retired) and result.requests <= limit,
+                      "rotation resumes once the hour rolls over")
+    daemon.close()
+
+    zone = {record['name'] for record in mock.state.zone('check').values()}
+    domains = set(GFWMass().load_domains())
+    checker.check(zone == domains and len(domains) == args.domains,
+                  f"the zone matches domains.txt ({len(domains)} domains)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the rotation budget against mock_cloudflare.py')
+    parser.add_argument('--domains', type=int, default=50, help='Domains in the rotated set (default: 50)')
+    parser.add_argument('--batch', type=int, default=5, help='Domains per rotation (default: 5)')
+    parser.add_argument('--batch-size', type=int, default=2,
+                        help='Cloudflare batch size; small so a rotation costs several requests (default: 2)')
+    parser.add_argument('--budget', type=int, default=7, help='Requests per hour (default: 7)')
+    parser.add_argument('--interval', type=float, default=600, help='Seconds between cycles (default: 600)')
+    args = parser.parse_args()
+
+    checker = Checker()
+    with tempfile.TemporaryDirectory() as workdir, MockCloudflare() as mock:
+        os.chdir(workdir)
+        write_config(mock.api_base, args)
+        run_checks(mock, args, checker)
+
+    if checker.failures:
+        print(f"\n{checker.failures} check(s) failed")
+        sys.exit(1)
+    print("\nAll checks passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -17,7 +17,7 @@ NC='\033[0m' # No Color
 
 # Cleanup function to remove generated files
 cleanup_files() {
-    rm -f Caddyfile xray_config.json domains.txt subscription.txt subscription_decoded.txt
+    rm -rf Caddyfile xray_config.json xray_config_*.json domains.txt subscription.txt subscription_decoded.txt subscription-*.txt subscriptions MANUAL_DNS.md .gfwmass-manifest.json
 }
 
 # Check if config exists
@@ -1,29 +1,1676 @@
 #!/usr/bin/env python3
 
+import asyncio
+import atexit
+import bisect
+import contextlib
+import cProfile
 import json
+import math
 import random
+import shlex
+import shutil
 import string
 import base64
+import fnmatch
+import gzip
+import hashlib
+import heapq
 import uuid
 import sys
+import tempfile
 import os
+import pstats
+import signal
+import socket
+import sqlite3
+import ssl
 import subprocess
-from typing import List, Dict, Any
+import threading
+import time
+from collections import OrderedDict, deque
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Dict, Any, Callable, Deque, Iterable, Iterator, NamedTuple, Optional, Set, Tuple
+from urllib.parse import urlparse
 import argparse
 
 try:
     import requests
+    from requests.adapters import HTTPAdapter
 except ImportError:
     print("Error: requests library not found. Please run: pip3 install requests")
     sys.exit(1)
 
 
+# Comment set on every record we create; --sync only deletes records that
+# carry it or that the state database knows about
+RECORD_COMMENT = "managed by gfwmass"
+
+# Cloudflare v4 API lives under /client/v4 (missing segment yields 7000 No route)
+CF_API_BASE = "https://api.cloudflare.com/client/v4"
+
+# Cloudflare allows 1200 API requests per 5 minutes per user/token
+CF_RATE_LIMIT = 1200 / 300
+
+# Largest dns_records/batch request accepted on the free plan (paid plans allow 3500)
+CF_BATCH_SIZE = 200
+
+# Base64 works on 3-byte groups; flushing multiples of 3 keeps the chunked
+# output identical to encoding the whole subscription at once
+SUBSCRIPTION_CHUNK = 3 * 16384
+
+# One subscription entry; {user_id} is the only per-user part
+LINK_TEMPLATE = ("vless://{user_id}@{domain}:443?encryption=none&security=tls"
+                 "&type=ws&host={domain}&path=/ws#{domain}")
+
+# Metric label for each kind of DNS records call (batch is matched by path)
+CF_CALLS = {'GET': 'list', 'POST': 'create', 'PATCH': 'patch', 'DELETE': 'delete'}
+
+# Cloudflare request latency histogram bounds, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Version probes used to skip reinstalling what a host already has
+DEPENDENCY_VERSION_COMMANDS = {
+    'caddy': ['caddy', 'version'],
+    'certbot': ['certbot', '--version'],
+    'xray': ['xray', 'version'],
+}
+CADDY_APT_SOURCE = "/etc/apt/sources.list.d/caddy-stable.list"
+CADDYFILE_PATH = "/etc/caddy/Caddyfile"
+
+# Inbound tags in generated Xray configs; clients are added and removed on
+# XRAY_INBOUND_TAG at runtime through the API inbound
+XRAY_INBOUND_TAG = "vless-ws"
+XRAY_API_TAG = "api"
+
+# Tuning presets picked with "tuning_profile": Xray policy level 0 (bufferSize in
+# KiB, timeouts in seconds), sockopt and domainStrategy for the freedom
+# outbound, and Caddy's reverse_proxy transport. No profile keeps the
+# defaults of both servers.
+PROFILES: Dict[str, Dict[str, Any]] = {
+    # Bulk transfers: large per-connection buffers, BBR, long-lived pools
+    'throughput': {
+        'policy': {'handshake': 8, 'connIdle': 600, 'uplinkOnly': 2, 'downlinkOnly': 5, 'bufferSize': 512},
+        'sockopt': {'tcpFastOpen': True, 'tcpKeepAliveIdle': 300, 'tcpKeepAliveInterval': 30,
+                    'tcpcongestion': 'bbr'},
+        'domain_strategy': 'UseIPv4',
+        'transport': {'keepalive': '5m', 'keepalive_idle_conns': 256,
+                      'read_buffer': '64KiB', 'write_buffer': '64KiB'},
+    },
+    # Interactive traffic: small buffers so nothing queues, Nagle off,
+    # quick dead-peer detection, resolver cache instead of per-dial lookups
+    'low-latency': {
+        'policy': {'handshake': 4, 'connIdle': 300, 'uplinkOnly': 1, 'downlinkOnly': 1, 'bufferSize': 4},
+        'sockopt': {'tcpFastOpen': True, 'tcpNoDelay': True, 'tcpKeepAliveIdle': 30,
+                    'tcpKeepAliveInterval': 15},
+        'domain_strategy': 'UseIP',
+        'transport': {'keepalive': '2m', 'keepalive_idle_conns': 128,
+                      'read_buffer': '4KiB', 'write_buffer': '4KiB'},
+    },
+    # Many mostly idle tunnels: no per-connection buffer, short idle
+    # timeouts so abandoned connections free their memory early
+    'many-conns': {
+        'policy': {'handshake': 4, 'connIdle': 120, 'uplinkOnly': 1, 'downlinkOnly': 1, 'bufferSize': 0},
+        'sockopt': {'tcpFastOpen': True, 'tcpKeepAliveIdle': 60, 'tcpKeepAliveInterval': 30},
+        'domain_strategy': 'UseIPv4',
+        'transport': {'keepalive': '90s', 'keepalive_idle_conns': 1024,
+                      'read_buffer': '4KiB', 'write_buffer': '4KiB'},
+    },
+}
+
+# (op, item, result, error): op is 'delete', 'patch' or 'post', item is the
+# request payload or existing record, result the record returned by Cloudflare
+Outcome = Tuple[str, Dict[str, Any], Optional[Dict[str, Any]], Optional[str]]
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> float:
+        # Reserve a token (possibly going negative) and sleep until it is ours,
+        # so concurrent callers queue up in order instead of spinning
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def penalize(self, seconds: float):
+        # Server told us to back off (429 Retry-After): drain the bucket so
+        # every worker waits, not just the one that got rejected
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class Clock:
+
+    # Wall time and waiting for the rotation daemon; ManualClock swaps in
+    # so schedules and budgets can be driven without real sleeps
+    def time(self) -> float:
+        return time.time()
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class ManualClock(Clock):
+
+    def __init__(self, start: float = 0.0):
+        self.now = start
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += max(0.0, seconds)
+
+    advance = sleep
+
+
+class RequestBudget:
+
+    # Cloudflare requests spent over a sliding window (an hour by default),
+    # so a long-running process stays under a fixed share of the account's
+    # API allowance whatever its schedule
+    def __init__(self, limit: int, clock: Clock, window: float = 3600.0):
+        self.limit = limit
+        self.clock = clock
+        self.window = window
+        self.spent: Deque[Tuple[float, int]] = deque()
+
+    def _expire(self):
+        horizon = self.clock.time() - self.window
+        while self.spent and self.spent[0][0] <= horizon:
+            self.spent.popleft()
+
+    def used(self) -> int:
+        self._expire()
+        return sum(count for _, count in self.spent)
+
+    def remaining(self) -> int:
+        return max(0, self.limit - self.used())
+
+    def spend(self, count: int, at: Optional[float] = None):
+        if count > 0:
+            self.spent.append((self.clock.time() if at is None else at, count))
+
+    def refill_at(self) -> Optional[float]:
+        # When the oldest spend leaves the window, or None if nothing is spent
+        self._expire()
+        return self.spent[0][0] + self.window if self.spent else None
+
+
+class Metrics:
+
+    # Wall time per phase plus, per kind of Cloudflare call, a latency
+    # histogram, status counts, retries and time spent waiting on the rate
+    # limiter. Exported as JSON or as a node_exporter textfile.
+    def __init__(self, profile_dir: Optional[str] = None):
+        self.profile_dir = profile_dir
+        self.started = time.time()
+        self.phases: 'OrderedDict[str, float]' = OrderedDict()
+        self.calls: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name: str, profile: bool = False) -> Iterator[None]:
+        profiler = cProfile.Profile() if profile and self.profile_dir else None
+        if profiler:
+            profiler.enable()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(name, time.perf_counter() - started)
+            if profiler:
+                profiler.disable()
+                self.dump_profile(name, profiler)
+
+    def record_phase(self, name: str, seconds: float):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def dump_profile(self, name: str, profiler: cProfile.Profile):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{name}.prof")
+        profiler.dump_stats(path)
+        print(f"\ncProfile for {name} written to {path} (top 10 by cumulative time):")
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(10)
+
+    def _call(self, call: str) -> Dict[str, Any]:
+        entry = self.calls.get(call)
+        if entry is None:
+            entry = self.calls[call] = {
+                'count': 0,
+                'seconds': 0.0,
+                'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+                'statuses': {},
+                'retries': 0,
+                'rate_limit_wait_seconds': 0.0,
+                'backoff_seconds': 0.0,
+            }
+        return entry
+
+    def observe_call(self, call: str, status: str, seconds: float, waited: float, retry: bool):
+        with self.lock:
+            entry = self._call(call)
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+            entry['retries'] += int(retry)
+            entry['rate_limit_wait_seconds'] += waited
+
+    def observe_backoff(self, call: str, seconds: float):
+        with self.lock:
+            self._call(call)['backoff_seconds'] += seconds
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            calls = {}
+            for call, entry in self.calls.items():
+                cumulative, histogram = 0, {}
+                for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), entry['buckets']):
+                    cumulative += count
+                    histogram['+Inf' if bound == float('inf') else f'{bound:g}'] = cumulative
+                calls[call] = dict(entry, buckets=histogram,
+                                   mean_ms=entry['seconds'] / entry['count'] * 1000 if entry['count'] else 0.0)
+            return {
+                'started_at': self.started,
+                'finished_at': time.time(),
+                'phases': dict(self.phases),
+                'cloudflare': calls,
+            }
+
+    def request_count(self) -> int:
+        # Every attempt, retries included: what Cloudflare rate-limits on
+        with self.lock:
+            return sum(entry['count'] for entry in self.calls.values())
+
+    def prometheus(self) -> str:
+        data = self.to_dict()
+        lines = [
+            "# HELP gfwmass_phase_seconds Wall time of each phase in the last run.",
+            "# TYPE gfwmass_phase_seconds gauge",
+        ]
+        lines += [f'gfwmass_phase_seconds{{phase="{name}"}} {seconds:.6f}' for name, seconds in data['phases'].items()]
+        lines += [
+            "# HELP gfwmass_cloudflare_request_duration_seconds Cloudflare API latency per attempt.",
+            "# TYPE gfwmass_cloudflare_request_duration_seconds histogram",
+        ]
+        for call, entry in data['cloudflare'].items():
+            for bound, count in entry['buckets'].items():
+                lines.append(f'gfwmass_cloudflare_request_duration_seconds_bucket{{call="{call}",le="{bound}"}} {count}')
+            lines.append(f'gfwmass_cloudflare_request_duration_seconds_sum{{call="{call}"}} {entry["seconds"]:.6f}')
+            lines.append(f'gfwmass_cloudflare_request_duration_seconds_count{{call="{call}"}} {entry["count"]}')
+        for metric, key, kind, help_text in (
+            ('gfwmass_cloudflare_retries_total', 'retries', 'counter', 'Cloudflare API attempts that were retries.'),
+            ('gfwmass_cloudflare_rate_limit_wait_seconds_total', 'rate_limit_wait_seconds', 'counter',
+             'Time spent waiting on the client-side rate limiter.'),
+            ('gfwmass_cloudflare_backoff_seconds_total', 'backoff_seconds', 'counter',
+             'Time spent backing off after errors.'),
+        ):
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}"]
+            lines += [f'{metric}{{call="{call}"}} {entry[key]:g}' for call, entry in data['cloudflare'].items()]
+        lines += [
+            "# HELP gfwmass_cloudflare_responses_total Cloudflare API responses by status code.",
+            "# TYPE gfwmass_cloudflare_responses_total counter",
+        ]
+        for call, entry in data['cloudflare'].items():
+            lines += [f'gfwmass_cloudflare_responses_total{{call="{call}",status="{status}"}} {count}'
+                      for status, count in sorted(entry['statuses'].items())]
+        lines += [
+            "# HELP gfwmass_last_run_timestamp_seconds When the last run finished.",
+            "# TYPE gfwmass_last_run_timestamp_seconds gauge",
+            f"gfwmass_last_run_timestamp_seconds {data['finished_at']:.0f}",
+        ]
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _write(path: str, content: str):
+        # The textfile collector may read at any moment: write, then rename
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+
+    def write_json(self, path: str):
+        self._write(path, json.dumps(self.to_dict(), indent=2) + '\n')
+
+    def write_prometheus(self, path: str):
+        self._write(path, self.prometheus())
+
+
+def is_record_error(code: Any) -> bool:
+    # Cloudflare error codes about one record (81xxx: duplicate, missing id,
+    # bad name...; 1004: DNS validation error) rather than the whole request
+    return isinstance(code, int) and (81000 <= code < 82000 or code == 1004)
+
+
+class CloudflareClient:
+
+    def __init__(self, api_token: str, zone_id: str, api_base: str = CF_API_BASE,
+                 workers: int = 8, rate_limit: float = CF_RATE_LIMIT, burst: int = 20,
+                 max_retries: int = 5, timeout: float = 30, batch_size: int = CF_BATCH_SIZE,
+                 limiter: Optional[TokenBucket] = None, metrics: Optional[Metrics] = None):
+        self.zone_id = zone_id
+        self.metrics = metrics
+        self.base_url = f"{api_base.rstrip('/')}/zones/{zone_id}/dns_records"
+        self.workers = max(1, workers)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.batch_size = max(1, batch_size)
+        self.batch_supported = True
+        # Cloudflare's limit is per account: clients for several zones share one
+        self.limiter = limiter or TokenBucket(rate_limit, burst)
+
+        # One keep-alive pool sized to the worker count, shared by all threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Authorization': f'Bearer {api_token}',
+            'Content-Type': 'application/json'
+        })
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], zone_id: Optional[str] = None,
+                    limiter: Optional[TokenBucket] = None,
+                    metrics: Optional[Metrics] = None) -> 'CloudflareClient':
+        cf = config['cloudflare']
+        return cls(
+            cf['api_token'],
+            zone_id or cf['zone_id'],
+            api_base=cf.get('api_base', CF_API_BASE),
+            workers=cf.get('workers', 8),
+            rate_limit=cf.get('rate_limit', CF_RATE_LIMIT),
+            burst=cf.get('burst', 20),
+            max_retries=cf.get('max_retries', 5),
+            timeout=cf.get('timeout', 30),
+            batch_size=cf.get('batch_size', CF_BATCH_SIZE) if cf.get('batch', True) else 1,
+            limiter=limiter,
+            metrics=metrics,
+        )
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(30.0, 0.5 * (2 ** attempt)))
+
+    def _retry_after(self, response: requests.Response) -> Optional[float]:
+        value = response.headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return None
+
+    def _observe(self, call: str, status: str, started: float, waited: float, attempt: int):
+        if self.metrics:
+            self.metrics.observe_call(call, status, time.perf_counter() - started, waited, attempt > 0)
+
+    def _sleep(self, call: str, seconds: float):
+        if self.metrics:
+            self.metrics.observe_backoff(call, seconds)
+        time.sleep(seconds)
+
+    def request(self, method: str, path: str = '', **kwargs) -> requests.Response:
+        url = f"{self.base_url}{path}"
+        call = 'batch' if path == '/batch' else CF_CALLS.get(method, method.lower())
+        attempt = 0
+        while True:
+            waited = self.limiter.acquire()
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except requests.RequestException:
+                self._observe(call, 'error', started, waited, attempt)
+                if attempt >= self.max_retries:
+                    raise
+                self._sleep(call, self._backoff(attempt))
+                attempt += 1
+                continue
+            self._observe(call, str(response.status_code), started, waited, attempt)
+
+            if response.status_code == 429 or response.status_code >= 500:
+                if attempt >= self.max_retries:
+                    return response
+                delay = self._retry_after(response)
+                if delay is None:
+                    delay = self._backoff(attempt)
+                if response.status_code == 429:
+                    self.limiter.penalize(delay)
+                else:
+                    self._sleep(call, delay)
+                attempt += 1
+                continue
+
+            return response
+
+    def list_records(self, record_type: str = 'A', page_size: int = 100) -> List[Dict[str, Any]]:
+        records = []
+        page = 1
+        while True:
+            response = self.request('GET', params={'type': record_type, 'page': page, 'per_page': page_size})
+            if response.status_code != 200:
+                raise RuntimeError(f"Failed to list {record_type} records (page {page}): {response.text}")
+            body = response.json()
+            records.extend(body.get('result') or [])
+            info = body.get('result_info') or {}
+            if page >= info.get('total_pages', 1) or not body.get('result'):
+                return records
+            page += 1
+
+    def delete_record(self, record_id: str) -> requests.Response:
+        return self.request('DELETE', f"/{record_id}")
+
+    def _error_text(self, response: requests.Response) -> str:
+        try:
+            errors = response.json().get('errors') or []
+        except ValueError:
+            return response.text
+        return '; '.join(f"{e.get('code')}: {e.get('message')}" for e in errors) or response.text
+
+    def _apply_single(self, op: str, item: Dict[str, Any]) -> Outcome:
+        try:
+            if op == 'post':
+                response = self.request('POST', json=item)
+            elif op == 'patch':
+                changes = {k: v for k, v in item.items() if k not in ('id', 'name')}
+                response = self.request('PATCH', f"/{item['id']}", json=changes)
+            else:
+                response = self.delete_record(item['id'])
+        except requests.RequestException as e:
+            return op, item, None, str(e)
+        if response.status_code in [200, 201]:
+            return op, item, response.json().get('result') or {}, None
+        return op, item, None, self._error_text(response)
+
+    def _apply_chunk(self, chunk: List[Tuple[str, Dict[str, Any]]]) -> List[Outcome]:
+        if len(chunk) == 1 or not self.batch_supported:
+            return [self._apply_single(op, item) for op, item in chunk]
+
+        deletes = [item for op, item in chunk if op == 'delete']
+        patches = [item for op, item in chunk if op == 'patch']
+        posts = [item for op, item in chunk if op == 'post']
+        body: Dict[str, Any] = {}
+        if deletes:
+            body['deletes'] = [{'id': item['id']} for item in deletes]
+        if patches:
+            body['patches'] = [{k: v for k, v in item.items() if k != 'name'} for item in patches]
+        if posts:
+            body['posts'] = posts
+
+        try:
+            response = self.request('POST', '/batch', json=body)
+        except requests.RequestException as e:
+            # Retries are spent; bisecting would only multiply failing requests
+            return [(op, item, None, str(e)) for op, item in chunk]
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        codes = [error.get('code') for error in body.get('errors') or [] if isinstance(error, dict)]
+
+        if response.status_code == 405 or (response.status_code == 404 and codes in ([], [7000])):
+            # Batch endpoint not available here; stay on the per-record path
+            self.batch_supported = False
+            return [self._apply_single(op, item) for op, item in chunk]
+
+        if not body.get('success'):
+            if response.status_code != 400 or not codes or not all(map(is_record_error, codes)):
+                # Auth, permission, zone, size, throttling or server errors
+                # fail every record alike: bisecting would only repeat them
+                error = f"HTTP {response.status_code}: {self._error_text(response)}"
+                return [(op, item, None, error) for op, item in chunk]
+            # Batches are atomic, so one invalid item fails the rest:
+            # bisect to isolate the ones Cloudflare rejects
+            middle = len(chunk) // 2
+            return self._apply_chunk(chunk[:middle]) + self._apply_chunk(chunk[middle:])
+
+        # Results come back in request order per operation type
+        result = body.get('result') or {}
+        outcomes: List[Outcome] = []
+        leftover: List[Tuple[str, Dict[str, Any]]] = []
+        for op, items, key in (('delete', deletes, 'deletes'), ('patch', patches, 'patches'),
+                               ('post', posts, 'posts')):
+            returned = result.get(key) or []
+            for i, item in enumerate(items):
+                if i < len(returned) and returned[i]:
+                    outcomes.append((op, item, returned[i], None))
+                else:
+                    leftover.append((op, item))
+        return outcomes + [self._apply_single(op, item) for op, item in leftover]
+
+    def apply(self, posts: Iterable[Dict[str, Any]] = (),
+              deletes: Iterable[Dict[str, Any]] = (),
+              patches: Iterable[Dict[str, Any]] = ()) -> Iterator[Outcome]:
+        # Same order Cloudflare executes a batch in: deletes, patches, posts
+        ops = ([('delete', item) for item in deletes] + [('patch', item) for item in patches] +
+               [('post', item) for item in posts])
+        chunks = [ops[i:i + self.batch_size] for i in range(0, len(ops), self.batch_size)]
+        for chunk, outcomes, error in self.map(self._apply_chunk, chunks):
+            if error is not None:
+                outcomes = [(op, item, None, str(error)) for op, item in chunk]
+            yield from outcomes
+
+    def map(self, fn: Callable[[Any], Any], items: Iterable[Any]):
+        # Yields (item, result, error) as each call completes
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(fn, item): item for item in items}
+            try:
+                for future in as_completed(futures):
+                    item = futures[future]
+                    try:
+                        yield item, future.result(), None
+                    except Exception as e:
+                        yield item, None, e
+            finally:
+                # Consumer stopped early (Ctrl-C, crash): drop queued calls
+                # so the state checkpoint matches what was actually sent
+                for future in futures:
+                    future.cancel()
+
+    def close(self):
+        self.session.close()
+
+
+SERVICE_PREFIXES = [
+    'cdn', 'api', 'static', 'assets', 'media', 'img', 'images', 'video', 'videos',
+    'auth', 'login', 'signin', 'signup', 'register', 'account', 'user', 'profile',
+    'app', 'web', 'mobile', 'www', 'm', 'secure', 'ssl', 'portal',
+    'gateway', 'edge', 'node', 'cloud', 'data', 'analytics', 'metrics',
+    'upload', 'download', 'files', 'docs', 'storage', 'backup',
+    'mail', 'smtp', 'imap', 'pop', 'webmail', 'exchange',
+    'shop', 'store', 'cart', 'checkout', 'payment', 'billing',
+    'support', 'help', 'ticket', 'chat', 'forum', 'community',
+    'blog', 'news', 'press', 'info', 'status', 'health', 'monitor',
+    'dashboard', 'admin', 'panel', 'console', 'manage', 'control',
+    'dev', 'staging', 'test', 'demo', 'preview', 'beta',
+    'us', 'eu', 'asia', 'jp', 'uk', 'de', 'fr', 'au', 'ca',
+    'east', 'west', 'north', 'south', 'central',
+    'lb', 'balancer', 'cache', 'dist', 'distribution', 'content',
+    'stream', 'live', 'vod', 'hls', 'rtmp', 'ws', 'wss',
+    'git', 'repo', 'registry', 'packages', 'npm', 'maven'
+]
+
+REGIONS = ['us', 'eu', 'asia', 'east', 'west', 'north', 'south', 'central']
+SUFFIXES = ['srv', 'svc', 'service', 'host', 'server', 'cluster', 'net']
+HASH_CHARS = string.ascii_lowercase + string.digits
+
+
+def _hash(digits: List[int]) -> str:
+    return ''.join(HASH_CHARS[d] for d in digits)
+
+
+# name -> (radices, render): every pattern is a mixed-radix number, so each
+# index in range(prod(radices)) maps to exactly one label
+SUBDOMAIN_PATTERNS = {
+    'prefix-hash': (
+        [len(SERVICE_PREFIXES)] + [len(HASH_CHARS)] * 4,
+        lambda d: f"{SERVICE_PREFIXES[d[0]]}-{_hash(d[1:])}"),
+    'prefix-number': (
+        [len(SERVICE_PREFIXES), 999],
+        lambda d: f"{SERVICE_PREFIXES[d[0]]}{d[1] + 1}"),
+    'hash-only': (
+        [len(HASH_CHARS)] * 8,
+        lambda d: _hash(d)),
+    'prefix-region-num': (
+        [len(SERVICE_PREFIXES), len(REGIONS), 99],
+        lambda d: f"{SERVICE_PREFIXES[d[0]]}-{REGIONS[d[1]]}-{d[2] + 1:02d}"),
+    'service-suffix': (
+        [len(SERVICE_PREFIXES), len(SUFFIXES)],
+        lambda d: f"{SERVICE_PREFIXES[d[0]]}-{SUFFIXES[d[1]]}"),
+    'multi-prefix': (
+        [len(REGIONS), len(SERVICE_PREFIXES)],
+        lambda d: f"{REGIONS[d[0]]}-{SERVICE_PREFIXES[d[1]]}"),
+    'numbered-prefix': (
+        [len(SERVICE_PREFIXES), 99],
+        lambda d: f"{SERVICE_PREFIXES[d[0]]}{d[1] + 1:02d}"),
+}
+
+
+class IndexSpace:
+
+    # Draws range(size) without replacement using a lazy Fisher-Yates
+    # shuffle: memory grows with the number of draws, not with size
+    def __init__(self, size: int, rng: random.Random):
+        self.size = size
+        self.drawn = 0
+        self.swaps: Dict[int, int] = {}
+        self.rng = rng
+
+    def exhausted(self) -> bool:
+        return self.drawn >= self.size
+
+    def draw(self) -> int:
+        i = self.drawn
+        j = self.rng.randrange(i, self.size)
+        value = self.swaps.get(j, j)
+        self.swaps[j] = self.swaps.pop(i, i)
+        self.drawn += 1
+        return value
+
+
+class SubdomainGenerator:
+
+    def __init__(self, base_domain: str, seed: Optional[int] = None,
+                 exclude: Iterable[str] = ()):
+        self.base_domain = base_domain
+        self.rng = random.Random(seed)
+        self.seen = set(exclude)
+        self.spaces = {
+            name: IndexSpace(self._size(radices), self.rng)
+            for name, (radices, _) in SUBDOMAIN_PATTERNS.items()
+        }
+
+    @staticmethod
+    def _size(radices: List[int]) -> int:
+        size = 1
+        for radix in radices:
+            size *= radix
+        return size
+
+    @staticmethod
+    def _decode(index: int, radices: List[int]) -> List[int]:
+        digits = []
+        for radix in reversed(radices):
+            index, digit = divmod(index, radix)
+            digits.append(digit)
+        digits.reverse()
+        return digits
+
+    def capacity(self) -> Dict[str, int]:
+        return {name: space.size - space.drawn for name, space in self.spaces.items()}
+
+    def generate(self, count: int) -> Iterator[str]:
+        # Patterns are picked uniformly; once a pattern's space runs out it
+        # drops out of the rotation and the rest absorb its share
+        active = [name for name, space in self.spaces.items() if not space.exhausted()]
+        produced = 0
+        while produced < count:
+            if not active:
+                raise ValueError(f"Subdomain space exhausted after {produced} of {count} names")
+            name = self.rng.choice(active)
+            space = self.spaces[name]
+            radices, render = SUBDOMAIN_PATTERNS[name]
+            subdomain = f"{render(self._decode(space.draw(), radices))}.{self.base_domain}"
+            if space.exhausted():
+                active.remove(name)
+            # Patterns can overlap (e.g. cdn42 from two of them), so the
+            # final guard is on the full name
+            if subdomain in self.seen:
+                continue
+            self.seen.add(subdomain)
+            produced += 1
+            yield subdomain
+
+
+class Zone(NamedTuple):
+    domain: str
+    zone_id: str
+
+
+class Origin(NamedTuple):
+    ip: str
+    weight: float
+
+
+class OriginRing:
+
+    # Weighted rendezvous hashing: a name goes to the origin with the highest
+    # weight / -ln(hash) score. Adding an origin only moves the names it now
+    # wins (about weight / total weight of them); the rest stay put.
+    def __init__(self, origins: Iterable[Origin]):
+        self.origins = [origin for origin in origins if origin.weight > 0]
+        if not self.origins:
+            raise ValueError("No origin with a positive weight configured")
+
+    @staticmethod
+    def _score(origin: Origin, name: str) -> float:
+        digest = hashlib.blake2b(f"{origin.ip}\0{name}".encode(), digest_size=8).digest()
+        return origin.weight / -math.log((int.from_bytes(digest, 'big') + 0.5) / 2 ** 64)
+
+    def pick(self, name: str) -> str:
+        if len(self.origins) == 1:
+            return self.origins[0].ip
+        return max(self.origins, key=lambda origin: self._score(origin, name)).ip
+
+
+_DRAINED = object()
+
+
+def interleave(sources: Dict[Any, Iterable[Any]]) -> Iterator[Tuple[Any, Any]]:
+    # Drains each iterable on its own thread and yields (key, item) as items
+    # arrive: per-zone work runs concurrently while the caller consumes on
+    # one thread
+    if len(sources) <= 1:
+        for key, iterable in sources.items():
+            for item in iterable:
+                yield key, item
+        return
+
+    queue: Queue = Queue()
+
+    def drain(key: Any, iterable: Iterable[Any]):
+        try:
+            for item in iterable:
+                queue.put((key, item, None))
+            queue.put((key, _DRAINED, None))
+        except Exception as e:
+            queue.put((key, _DRAINED, e))
+
+    for key, iterable in sources.items():
+        threading.Thread(target=drain, args=(key, iterable), daemon=True).start()
+
+    remaining = len(sources)
+    while remaining:
+        key, item, error = queue.get()
+        if item is _DRAINED:
+            remaining -= 1
+            if error is not None:
+                raise error
+            continue
+        yield key, item
+
+
+def percentile(values: List[float], p: float) -> float:
+    # Nearest-rank percentile; values need not be sorted
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class StateStore:
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS domains (
+            name TEXT PRIMARY KEY,
+            zone_id TEXT NOT NULL,
+            record_id TEXT,
+            content TEXT,
+            status TEXT NOT NULL,
+            deploy_id INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS domains_status ON domains (status);
+        CREATE INDEX IF NOT EXISTS domains_deploy ON domains (deploy_id, status);
+        CREATE TABLE IF NOT EXISTS users (
+            email TEXT PRIMARY KEY,
+            id TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS rotations (
+            at REAL NOT NULL,
+            retired INTEGER NOT NULL,
+            added INTEGER NOT NULL,
+            requests INTEGER NOT NULL
+        );
+    """
+
+    # Statuses: pending (not yet confirmed), rotating (added by the rotation
+    # daemon, not yet confirmed), active (record exists, id known), failed
+    # (Cloudflare rejected it), removed
+    def __init__(self, path: str, checkpoint_every: int = 100):
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        # The deploy pipeline provisions DNS off the main thread; access
+        # stays serialised, so sharing the connection is safe
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self.buffer: List[Tuple[str, Optional[str], Optional[str], int, str]] = []
+
+    def begin_deploy(self, rows: Iterable[Tuple[str, str, str]]) -> int:
+        # rows: (name, zone_id, content)
+        deploy_id = (self.db.execute("SELECT MAX(deploy_id) FROM domains").fetchone()[0] or 0) + 1
+        now = int(time.time())
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO domains (name, zone_id, content, status, deploy_id, created_at, updated_at) "
+                "VALUES (?, ?, ?, 'pending', ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET deploy_id = excluded.deploy_id, zone_id = excluded.zone_id, "
+                "content = excluded.content, updated_at = excluded.updated_at, "
+                "status = CASE WHEN status = 'active' THEN 'active' ELSE 'pending' END",
+                ((name, zone_id, content, deploy_id, now, now) for name, zone_id, content in rows))
+        return deploy_id
+
+    def begin_rotation(self, rows: Iterable[Tuple[str, str, str]]):
+        # rows: (name, zone_id, content). Kept apart from 'pending' so an
+        # interrupted rotation is never resumed as if it were a --deploy
+        now = int(time.time())
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO domains (name, zone_id, content, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, 'rotating', ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET zone_id = excluded.zone_id, content = excluded.content, "
+                "status = 'rotating', updated_at = excluded.updated_at",
+                ((name, zone_id, content, now, now) for name, zone_id, content in rows))
+
+    def rotating(self) -> List[Tuple[str, Optional[str]]]:
+        return list(self.db.execute(
+            "SELECT name, record_id FROM domains WHERE status = 'rotating' ORDER BY rowid"))
+
+    def finish_rotation(self):
+        # domains.txt now lists them: created records become ordinary ones
+        with self.db:
+            self.db.execute(
+                "UPDATE domains SET status = 'active', updated_at = ? "
+                "WHERE status = 'rotating' AND record_id IS NOT NULL", (int(time.time()),))
+
+    def abandon(self):
+        with self.db:
+            self.db.execute(
+                "UPDATE domains SET status = 'failed', error = 'abandoned', updated_at = ? "
+                "WHERE status = 'pending'", (int(time.time()),))
+
+    def interrupted_deploy(self) -> Optional[int]:
+        row = self.db.execute(
+            "SELECT MAX(deploy_id) FROM domains WHERE status = 'pending'").fetchone()
+        return row[0]
+
+    def deploy_domains(self, deploy_id: int) -> List[str]:
+        return [row[0] for row in self.db.execute(
+            "SELECT name FROM domains WHERE deploy_id = ? AND status != 'removed' ORDER BY rowid",
+            (deploy_id,))]
+
+    def lookup(self, names: Iterable[str]) -> Dict[str, Tuple[str, Optional[str]]]:
+        # name -> (status, record_id), by primary key in chunks under
+        # SQLite's bound-parameter limit
+        names = list(names)
+        found: Dict[str, Tuple[str, Optional[str]]] = {}
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            query = f"SELECT name, status, record_id FROM domains WHERE name IN ({','.join('?' * len(chunk))})"
+            for name, status, record_id in self.db.execute(query, chunk):
+                found[name] = (status, record_id)
+        return found
+
+    def record(self, name: str, status: str, record_id: Optional[str] = None, error: Optional[str] = None):
+        self.buffer.append((status, record_id, error, int(time.time()), name))
+        if len(self.buffer) >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        if not self.buffer:
+            return
+        with self.db:
+            self.db.executemany(
+                "UPDATE domains SET status = ?, record_id = COALESCE(?, record_id), error = ?, updated_at = ? "
+                "WHERE name = ?", self.buffer)
+        self.buffer = []
+
+    def upsert(self, records: Iterable[Dict[str, Any]], zone_id: str):
+        # Adopt records seen in the zone (e.g. created just before a crash)
+        now = int(time.time())
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO domains (name, zone_id, record_id, content, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 'active', ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET record_id = excluded.record_id, status = 'active', "
+                "error = NULL, updated_at = excluded.updated_at",
+                ((r['name'], zone_id, r['id'], r.get('content'), now, now) for r in records))
+
+    def names(self) -> Set[str]:
+        return {row[0] for row in self.db.execute("SELECT name FROM domains")}
+
+    def log_rotation(self, at: float, retired: int, added: int, requests: int):
+        with self.db:
+            self.db.execute("INSERT INTO rotations (at, retired, added, requests) VALUES (?, ?, ?, ?)",
+                            (at, retired, added, requests))
+
+    def rotation_requests(self, since: float) -> List[Tuple[float, int]]:
+        return list(self.db.execute(
+            "SELECT at, requests FROM rotations WHERE at > ? ORDER BY at", (since,)))
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self.db.execute("SELECT status, COUNT(*) FROM domains GROUP BY status"))
+
+    def users(self) -> List[Tuple[str, str]]:
+        return list(self.db.execute("SELECT email, id FROM users ORDER BY created_at, email"))
+
+    def user(self, email: str) -> Optional[str]:
+        row = self.db.execute("SELECT id FROM users WHERE email = ?", (email,)).fetchone()
+        return row[0] if row else None
+
+    def add_user(self, email: str, user_id: str):
+        with self.db:
+            self.db.execute(
+                "INSERT INTO users (email, id, created_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(email) DO UPDATE SET id = excluded.id",
+                (email, user_id, int(time.time())))
+
+    def remove_user(self, email: str) -> bool:
+        with self.db:
+            return self.db.execute("DELETE FROM users WHERE email = ?", (email,)).rowcount > 0
+
+    def failures(self, limit: int = 10) -> List[Tuple[str, str]]:
+        return list(self.db.execute(
+            "SELECT name, error FROM domains WHERE status = 'failed' ORDER BY updated_at DESC LIMIT ?", (limit,)))
+
+    def close(self):
+        self.checkpoint()
+        self.db.close()
+
+
+class User(NamedTuple):
+    email: str
+    id: str
+
+
+class LinkTemplate:
+
+    # A subscription for a fixed domain list, split around the user id.
+    # Links differ only in the UUID, so rendering a user is a single
+    # bytes.join over precomputed segments rather than formatting every link.
+    def __init__(self, domains: Iterable[str]):
+        suffixes = []
+        prefix = b''
+        for domain in domains:
+            prefix, suffix = LINK_TEMPLATE.format(user_id='\0', domain=domain).encode().split(b'\0')
+            suffixes.append(suffix)
+        if suffixes:
+            self.segments = [prefix] + [suffix + b'\n' + prefix for suffix in suffixes[:-1]] + [suffixes[-1]]
+        else:
+            self.segments = []
+        self.count = len(suffixes)
+        digest = hashlib.sha256()
+        for segment in self.segments:
+            digest.update(segment)
+        self.digest = digest.hexdigest()
+
+    def render(self, user_id: str) -> bytes:
+        return user_id.encode().join(self.segments)
+
+
+class SubscriptionBody(NamedTuple):
+    plain: bytes
+    gzipped: bytes
+    etag: str
+    gzip_etag: str  # another content coding is another representation
+
+
+class SubscriptionCache:
+
+    def __init__(self, gfw: 'GFWMass', domains_path: str = 'domains.txt',
+                 shard_size: int = 0, max_shards: int = 4096, probe_path: Optional[str] = None):
+        self.gfw = gfw
+        self.domains_path = domains_path
+        # Probe results rank and filter the links, so they key the cache too
+        self.probe_path = probe_path
+        self.shard_size = shard_size
+        self.max_shards = max_shards
+        self.lock = threading.Lock()
+        self.stamp: Optional[Tuple[int, ...]] = None
+        self.domains: List[str] = []
+        self.full: Optional[SubscriptionBody] = None
+        self.shards: 'OrderedDict[str, SubscriptionBody]' = OrderedDict()
+
+    @staticmethod
+    def build(encoded: str) -> SubscriptionBody:
+        plain = encoded.encode()
+        digest = hashlib.sha256(plain).hexdigest()[:32]
+        return SubscriptionBody(plain, gzip.compress(plain, 9, mtime=0), f'"{digest}"', f'"{digest}-gz"')
+
+    @staticmethod
+    def file_stamp(path: Optional[str]) -> Tuple[int, int]:
+        try:
+            st = os.stat(path) if path else None
+        except OSError:
+            st = None
+        return (st.st_mtime_ns, st.st_size) if st else (0, 0)
+
+    def refresh(self):
+        # Cheap stats per request; bodies are only rebuilt when domains.txt
+        # or the probe results change
+        stamp = self.file_stamp(self.domains_path) + self.file_stamp(self.probe_path)
+        with self.lock:
+            if stamp == self.stamp:
+                return
+            self.domains = self.gfw.load_domains(self.domains_path)
+            self.full = self.build(self.gfw.generate_subscription(self.domains))
+            self.shards.clear()
+            self.stamp = stamp
+
+    def shard_domains(self, token: str) -> List[str]:
+        # Rendezvous hashing: each token keeps its shard when unrelated
+        # domains are added or removed
+        def score(domain: str) -> bytes:
+            return hashlib.blake2b(f"{token}\0{domain}".encode(), digest_size=8).digest()
+        return heapq.nlargest(self.shard_size, self.domains, key=score)
+
+    def get(self, token: Optional[str] = None) -> SubscriptionBody:
+        self.refresh()
+        with self.lock:
+            if not token or self.shard_size <= 0 or self.shard_size >= len(self.domains):
+                return self.full
+            body = self.shards.get(token)
+            if body is not None:
+                self.shards.move_to_end(token)
+                return body
+            domains = self.shard_domains(token)
+            stamp = self.stamp
+        body = self.build(self.gfw.generate_subscription(domains))
+        with self.lock:
+            # A refresh() while building means the shard is of the old list:
+            # serve it to this request but don't cache it
+            if self.stamp == stamp:
+                self.shards[token] = body
+                if len(self.shards) > self.max_shards:
+                    self.shards.popitem(last=False)
+        return body
+
+
+class SubscriptionHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server: 'SubscriptionServer'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _token(self) -> Tuple[bool, Optional[str]]:
+        path = urlparse(self.path).path.rstrip('/')
+        prefix = self.server.path.rstrip('/')
+        if path == prefix:
+            token = None
+        elif path.startswith(prefix + '/'):
+            token = path[len(prefix) + 1:]
+        else:
+            return False, None
+        tokens = self.server.tokens
+        if tokens is not None and token not in tokens:
+            return False, None
+        return True, token
+
+    def _respond(self, include_body: bool):
+        found, token = self._token()
+        if not found:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = self.server.cache.get(token)
+        use_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        etag = body.gzip_etag if use_gzip else body.etag
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+
+        payload = body.gzipped if use_gzip else body.plain
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        if include_body:
+            self.wfile.write(payload)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+
+class SubscriptionServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], cache: SubscriptionCache,
+                 path: str = '/sub', tokens: Optional[Iterable[str]] = None):
+        super().__init__(address, SubscriptionHandler)
+        self.cache = cache
+        self.path = path
+        self.tokens = set(tokens) if tokens is not None else None
+
+
+class ArtifactFile:
+
+    def __init__(self, store: 'ArtifactStore', path: str, key: Optional[str] = None):
+        self.store = store
+        self.path = path
+        self.key = key
+        self.temp_path = f"{path}.{os.getpid()}.tmp"
+        self.digest = hashlib.sha256()
+        self.changed = False
+
+    def __enter__(self) -> 'ArtifactFile':
+        self.file = open(self.temp_path, 'wb')
+        return self
+
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode()
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is not None:
+            os.unlink(self.temp_path)
+            return False
+        self.changed = self.store.commit(self.path, self.temp_path, self.digest.hexdigest(), self.key)
+        return False
+
+
+class ArtifactStore:
+
+    # Every output is written to a temp file next to its destination and
+    # hashed on the way; it is only renamed into place when the hash differs
+    # from the file already there, so unchanged outputs keep their inode
+    # and mtime. The manifest remembers each output's hash, the stat it had
+    # when written (to avoid rehashing) and the hash last deployed, so an
+    # output whose hash differs from its deployed one is pending a copy.
+    def __init__(self, path: str = '.gfwmass-manifest.json'):
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.changed: List[str] = []
+        self.unchanged: List[str] = []
+        self.saved: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f).get('artifacts', {})
+            except (OSError, ValueError):
+                print(f"Warning: {path} is unreadable, rebuilding every artifact")
+            self.saved = json.loads(json.dumps(self.entries))
+
+    @staticmethod
+    def hash_file(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def current_hash(self, path: str) -> Optional[str]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry and entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns:
+            return entry['sha256']
+        return self.hash_file(path)
+
+    def open(self, path: str, key: Optional[str] = None) -> ArtifactFile:
+        # key: digest of everything the output is rendered from, so fresh()
+        # can skip rendering it at all next time
+        return ArtifactFile(self, path, key)
+
+    def fresh(self, path: str, key: str) -> bool:
+        with self.lock:
+            entry = self.entries.get(path)
+        if not entry or entry.get('key') != key:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns
+
+    def commit(self, path: str, temp_path: str, digest: str, key: Optional[str] = None) -> bool:
+        if self.current_hash(path) == digest:
+            os.unlink(temp_path)
+            changed = False
+        else:
+            os.replace(temp_path, path)
+            changed = True
+        stat = os.stat(path)
+        with self.lock:
+            (self.changed if changed else self.unchanged).append(path)
+            entry = self.entries.setdefault(path, {})
+            entry.update({'sha256': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+            if key is not None:
+                entry['key'] = key
+        return changed
+
+    def rendered_in(self, directory: str) -> List[str]:
+        # Outputs in directory that were written with a render key
+        directory = os.path.normpath(directory)
+        with self.lock:
+            return [path for path, entry in self.entries.items()
+                    if entry.get('key') is not None and os.path.normpath(os.path.dirname(path)) == directory]
+
+    def unkeyed(self, pattern: str) -> List[str]:
+        # Outputs matching a glob that were written without a render key
+        with self.lock:
+            return [path for path, entry in self.entries.items()
+                    if entry.get('key') is None and fnmatch.fnmatch(path, pattern)]
+
+    def forget(self, path: str):
+        with self.lock:
+            self.entries.pop(path, None)
+
+    def needs_deploy(self, source: str, target: str) -> bool:
+        entry = self.entries.get(source)
+        if not entry or entry.get('deployed') != entry.get('sha256'):
+            return True
+        try:
+            return os.path.getsize(target) != entry.get('size')
+        except OSError:
+            return True
+
+    def deploy(self, source: str, target: str, backup: Optional[str] = None) -> bool:
+        # backup: where to keep the file being replaced, for revert()
+        if not self.needs_deploy(source, target):
+            return False
+        temp_path = f"{target}.{os.getpid()}.tmp"
+        try:
+            shutil.copyfile(source, temp_path)
+            if os.path.exists(target):
+                shutil.copymode(target, temp_path)
+                if backup:
+                    shutil.copy2(target, backup)
+            elif backup and os.path.exists(backup):
+                os.unlink(backup)
+            os.replace(temp_path, target)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        entry = self.entries.setdefault(source, {})
+        if 'sha256' not in entry:
+            entry['sha256'] = self.hash_file(source)
+        entry['deployed'] = entry['sha256']
+        return True
+
+    def revert(self, source: str, target: str, backup: str):
+        # Put back what deploy() replaced and leave the source pending, so
+        # the next run copies it again
+        if os.path.exists(backup):
+            os.replace(backup, target)
+        elif os.path.exists(target):
+            os.unlink(target)
+        entry = self.entries.get(source)
+        if entry:
+            entry.pop('deployed', None)
+
+    def save(self):
+        if self.entries == self.saved:
+            return
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({'artifacts': self.entries}, f, indent=2)
+        os.replace(temp_path, self.path)
+        self.saved = json.loads(json.dumps(self.entries))
+
+
+class StageResult(NamedTuple):
+    name: str
+    status: str  # 'ok', 'failed' or 'skipped'
+    seconds: float
+    error: Optional[str]
+
+
+class ServiceChange(NamedTuple):
+    service: str
+    api: Optional[str]                      # Xray API address; None for Caddy
+    add_inbounds: List[Dict[str, Any]]      # inbounds holding only the clients to add
+    remove_users: List[Tuple[str, str]]     # (inbound tag, client email)
+    restart: bool                           # topology changed, cannot apply live
+
+
+class TaskGraph:
+
+    def __init__(self):
+        self.tasks: 'OrderedDict[str, Tuple[Callable[[], Any], Tuple[str, ...]]]' = OrderedDict()
+
+    def add(self, name: str, fn: Callable[[], Any], after: Iterable[str] = ()) -> 'TaskGraph':
+        after = tuple(after)
+        for dep in after:
+            if dep not in self.tasks:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dep}'")
+        self.tasks[name] = (fn, after)
+        return self
+
+    @staticmethod
+    def _timed(name: str, fn: Callable[[], Any]) -> StageResult:
+        started = time.perf_counter()
+        try:
+            value = fn()
+        except Exception as e:
+            print(f"Error: stage '{name}' failed: {e}")
+            return StageResult(name, 'failed', time.perf_counter() - started, str(e))
+        status = 'failed' if value is False else 'ok'
+        return StageResult(name, status, time.perf_counter() - started, None)
+
+    def run(self) -> List[StageResult]:
+        # Stages start as soon as everything they come after has succeeded;
+        # a stage that raises or returns False skips everything downstream
+        results: Dict[str, StageResult] = {}
+        pending = OrderedDict(self.tasks)
+        running: Dict[Any, str] = {}
+
+        with ThreadPoolExecutor(max_workers=max(1, len(self.tasks))) as pool:
+            while pending or running:
+                for name, (fn, after) in list(pending.items()):
+                    if any(dep in results and results[dep].status != 'ok' for dep in after):
+                        results[name] = StageResult(name, 'skipped', 0.0, 'upstream stage failed')
+                        del pending[name]
+                    elif all(dep in results for dep in after):
+                        running[pool.submit(self._timed, name, fn)] = name
+                        del pending[name]
+
+                if running:
+                    future = next(as_completed(running))
+                    results[running.pop(future)] = future.result()
+
+        return [results[name] for name in self.tasks]
+
+
+class RotationResult(NamedTuple):
+    at: float
+    retired: List[str]
+    added: List[str]
+    failed: int
+    requests: int       # Cloudflare requests actually sent, retries included
+    budget_left: int
+
+
+class RotationDaemon:
+
+    # Swaps the least wanted domains (failed probes first, then the oldest;
+    # domains.txt is kept oldest first) for fresh names on a fixed schedule.
+    # One process keeps the Cloudflare sessions open across cycles, and each
+    # cycle is shrunk to what the hourly request budget still allows.
+    def __init__(self, gfw: 'GFWMass', clock: Optional[Clock] = None):
+        options = gfw.config.get('rotation', {})
+        self.gfw = gfw
+        self.clock = clock or Clock()
+        self.interval = options.get('interval', 600)
+        self.batch = options.get('batch', 10)
+        self.probe = options.get('probe', False)
+        self.budget = RequestBudget(options.get('hourly_budget', 600), self.clock)
+        self.clients: Optional[Dict[Zone, CloudflareClient]] = None
+        self.retired: Set[str] = set()
+
+        state = gfw.state_store()
+        if state:
+            # Requests spent before a restart still count against this hour
+            for at, count in state.rotation_requests(self.clock.time() - self.budget.window):
+                self.budget.spend(count, at)
+
+    def zone_clients(self) -> Dict[Zone, CloudflareClient]:
+        if self.clients is None:
+            self.clients = self.gfw.zone_clients()
+        return self.clients
+
+    def close(self):
+        for client in (self.clients or {}).values():
+            client.close()
+        self.clients = None
+
+    def candidates(self, domains: List[str]) -> List[str]:
+        results = self.gfw.probe_domains(domains) if self.probe else self.gfw.load_probe_results()
+        unhealthy = [domain for domain in domains if domain in results and not results[domain].get('ok')]
+        skip = set(unhealthy)
+        ordered = unhealthy + [domain for domain in domains if domain not in skip]
+        return [domain for domain in ordered if self.gfw.zone_for(domain) is not None]
+
+    def cost(self, retire: List[str], fresh: List[str],
+             known: Dict[str, Tuple[str, Optional[str]]], sizes: Dict[Zone, int]) -> int:
+        # Requests a rotation takes when nothing is retried: its batches per
+        # zone, plus a zone listing wherever a record id is not on file
+        clients = self.zone_clients()
+        page_size = self.gfw.config['cloudflare'].get('list_page_size', 1000)
+        ops: Dict[Zone, int] = {}
+        listed: Set[Zone] = set()
+        for name in retire:
+            zone = self.gfw.zone_for(name)
+            ops[zone] = ops.get(zone, 0) + 1
+            status, record_id = known.get(name, (None, None))
+            if not (status == 'active' and record_id):
+                listed.add(zone)
+        for name in fresh:
+            zone = self.gfw.zone_for(name)
+            ops[zone] = ops.get(zone, 0) + 1
+        total = 0
+        for zone, count in ops.items():
+            size = clients[zone].batch_size if clients[zone].batch_supported else 1
+            total += -(-count // size)
+        for zone in listed:
+            total += max(1, -(-sizes.get(zone, 0) // page_size))
+        return total
+
+    def apply(self, retire: List[str], fresh: List[str],
+              known: Dict[str, Tuple[str, Optional[str]]]) -> Tuple[List[str], List[str], int]:
+        gfw = self.gfw
+        state = gfw.state_store()
+        clients = self.zone_clients()
+
+        deletes: Dict[Zone, List[Dict[str, Any]]] = {}
+        unknown: Dict[Zone, List[str]] = {}
+        for name in retire:
+            zone = gfw.zone_for(name)
+            status, record_id = known.get(name, (None, None))
+            if status == 'active' and record_id:
+                deletes.setdefault(zone, []).append({'id': record_id, 'name': name})
+            else:
+                unknown.setdefault(zone, []).append(name)
+
+        removed: List[str] = []
+        for zone, names in unknown.items():
+            try:
+                index = gfw.fetch_zone_index(clients[zone])
+            except (RuntimeError, requests.RequestException) as e:
+                print(f"Warning: could not index {zone.domain} ({e}); keeping {len(names)} domains for now")
+                continue
+            deletes.setdefault(zone, []).extend(gfw.select_records(index, names))
+            # No record left in the zone: nothing to delete, just drop it
+            removed.extend(name for name in names if name not in index)
+
+        posts: Dict[Zone, List[Dict[str, Any]]] = {}
+        for name in fresh:
+            posts.setdefault(gfw.zone_for(name), []).append(gfw.record_payload(name))
+        if state:
+            state.begin_rotation((record['name'], zone.zone_id, record['content'])
+                               for zone, records in posts.items() for record in records)
+
+        zones = list(dict.fromkeys(list(deletes) + list(posts)))
+        batches = {zone: clients[zone].apply(posts=posts.get(zone, ()), deletes=deletes.get(zone, ()))
+                   for zone in zones}
+        added: List[str] = []
+        failed = 0
+        for _, (op, record, result, error) in interleave(batches):
+            if op == 'delete' and (error is None or error.startswith('81044')):
+                removed.append(record['name'])
+                if state:
+                    state.record(record['name'], 'removed')
+            elif op == 'post' and error is None:
+                added.append(record['name'])
+                if state:
+                    # Stays 'rotating' until domains.txt lists it
+                    state.record(record['name'], 'rotating', result.get('id'))
+            else:
+                failed += 1
+                print(f"Failed to {op} {record['name']}: {error}")
+                if state and op == 'post':
+                    state.record(record['name'], 'failed', error=error)
+        if state:
+            state.checkpoint()
+        return list(dict.fromkeys(removed)), added, failed
+
+    def recover(self):
+        # A rotation cut short (SIGTERM, crash) can leave new records in the
+        # zone that domains.txt never got, and retired ones still listed.
+        # Adopt the first, drop the second, fail what never reached the zone.
+        gfw = self.gfw
+        state = gfw.state_store()
+        if state is None:
+            return
+        domains = gfw.load_domains()
+        known = state.lookup(domains)
+        gone = {domain for domain in domains if known.get(domain, ('',))[0] == 'removed'}
+        rotating = state.rotating()
+
+        # Created and confirmed: only the domains.txt write was missed
+        adopted = [name for name, record_id in rotating if record_id]
+        unconfirmed = [name for name, record_id in rotating if not record_id]
+        if unconfirmed:
+            clients = self.zone_clients()
+            before = gfw.metrics.request_count()
+            listed_by_zone = gfw.group_by_zone(domains)
+            for zone, names in gfw.group_by_zone(unconfirmed).items():
+                if not names:
+                    continue
+                try:
+                    index = gfw.fetch_zone_index(clients[zone])
+                except (RuntimeError, requests.RequestException) as e:
+                    print(f"Warning: could not index {zone.domain} ({e}); recovery retried at next start")
+                    continue
+                # Deletes from the same cut-short batch may have landed too
+                for name in listed_by_zone.get(zone, []):
+                    if name not in index and name not in gone:
+                        gone.add(name)
+                        state.record(name, 'removed')
+                for name in names:
+                    if name in index:
+                        state.record(name, 'rotating', index[name][0]['id'])
+                        adopted.append(name)
+                    else:
+                        state.record(name, 'failed', error='interrupted rotation')
+            state.checkpoint()
+            spent = gfw.metrics.request_count() - before
+            self.budget.spend(spent)
+            state.log_rotation(self.clock.time(), 0, len(adopted), spent)
+
+        listed = set(domains)
+        adopted = [name for name in adopted if name not in listed]
+        if gone or adopted:
+            gfw.domains = [domain for domain in domains if domain not in gone] + adopted
+            gfw.write_subscriptions()
+            gfw.artifacts().save()
+            print(f"Recovered an interrupted rotation: {len(adopted)} domains adopted, {len(gone)} dropped")
+        state.finish_rotation()
+
+    def rotate_once(self) -> RotationResult:
+        gfw = self.gfw
+        state = gfw.state_store()
+        now = self.clock.time()
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))
+
+        domains = gfw.load_domains()
+        if not domains:
+            print(f"[{stamp}] domains.txt is empty; deploy a set before rotating it")
+            return RotationResult(now, [], [], 0, 0, self.budget.remaining())
+
+        candidates = self.candidates(domains)[:self.batch]
+        known = state.lookup(candidates) if state else {}
+        exclude = set(domains) | self.retired | (state.names() if state else set())
+        fresh = list(gfw.iter_subdomains(len(candidates), exclude=exclude))
+        sizes = {zone: len(names) for zone, names in gfw.group_by_zone(domains).items()}
+
+        remaining = self.budget.remaining()
+        count = len(candidates)
+        while count and self.cost(candidates[:count], fresh[:count], known, sizes) > remaining:
+            count -= 1
+        if count < len(candidates):
+            refill = self.budget.refill_at()
+            when = time.strftime('%H:%M:%S', time.localtime(refill)) if refill else 'now'
+            print(f"[{stamp}] Budget: {remaining} of {self.budget.limit} requests left this hour, "
+                  f"rotating {count} of {len(candidates)} (more from {when})")
+        if not count:
+            return RotationResult(now, [], [], 0, 0, remaining)
+
+        before = gfw.metrics.request_count()
+        with gfw.metrics.phase('rotate'):
+            removed, added, failed = self.apply(candidates[:count], fresh[:count], known)
+        spent = gfw.metrics.request_count() - before
+        self.budget.spend(spent)
+        self.retired.update(removed)
+        if state:
+            state.log_rotation(now, len(removed), len(added), spent)
+
+        if removed or added:
+            gone = set(removed)
+            gfw.domains = [domain for domain in domains if domain not in gone] + added
+            with gfw.metrics.phase('save'):
+                gfw.write_subscriptions()
+                gfw.artifacts().save()
+        if state:
+            state.finish_rotation()
+
+        print(f"[{stamp}] Rotated: {len(removed)} retired, {len(added)} added, {failed} failed; "
+              f"{spent} requests, {self.budget.remaining()}/{self.budget.limit} left this hour")
+        return RotationResult(now, removed, added, failed, spent, self.budget.remaining())
+
+    def run(self, cycles: Optional[int] = None):
+        # Cycles start on a fixed grid; one that overruns the interval makes
+        # the next start right away instead of bunching up several
+        print(f"Rotating up to {self.batch} domains every {self.interval:g}s "
+              f"within {self.budget.limit} Cloudflare requests per hour")
+        next_at = self.clock.time()
+        done = 0
+        try:
+            self.recover()
+            while cycles is None or done < cycles:
+                self.clock.sleep(next_at - self.clock.time())
+                try:
+                    self.rotate_once()
+                except (RuntimeError, OSError, ValueError, requests.RequestException) as e:
+                    print(f"Error: rotation failed, retrying next cycle: {e}")
+                done += 1
+                next_at = max(next_at + self.interval, self.clock.time())
+        finally:
+            self.close()
+
+
 class GFWMass:
     
     def __init__(self, config_file: str = "config.json"):
         self.config = self.load_config(config_file)
         self.domains = []
+        self.seed = self.config.get('seed')
+        self.state: Optional[StateStore] = None
+        self.artifact_store: Optional[ArtifactStore] = None
+        self.ring: Optional[OriginRing] = None
+        self.metrics = Metrics()
+        self.default: Optional[User] = None
+        self.user_cache: Optional[List[User]] = None
         
+    def tuning_profile(self) -> Optional[Dict[str, Any]]:
+        name = self.config.get('tuning_profile')
+        if not name:
+            return None
+        if name not in PROFILES:
+            raise ValueError(f"Unknown tuning_profile '{name}' (available: {', '.join(PROFILES)})")
+        return PROFILES[name]
+
     def load_config(self, config_file: str) -> Dict[str, Any]:
         if not os.path.exists(config_file):
             print(f"Error: Configuration file '{config_file}' not found.")
@@ -33,182 +1680,576 @@ class GFWMass:
         with open(config_file, 'r') as f:
             return json.load(f)
     
-    def generate_subdomains(self, count: int = 100) -> List[str]:
-        service_prefixes = [
-            'cdn', 'api', 'static', 'assets', 'media', 'img', 'images', 'video', 'videos',
-            'auth', 'login', 'signin', 'signup', 'register', 'account', 'user', 'profile',
-            'app', 'web', 'mobile', 'www', 'm', 'secure', 'ssl', 'portal',
-            'gateway', 'edge', 'node', 'cloud', 'data', 'analytics', 'metrics',
-            'upload', 'download', 'files', 'docs', 'storage', 'backup',
-            'mail', 'smtp', 'imap', 'pop', 'webmail', 'exchange',
-            'shop', 'store', 'cart', 'checkout', 'payment', 'billing',
-            'support', 'help', 'ticket', 'chat', 'forum', 'community',
-            'blog', 'news', 'press', 'info', 'status', 'health', 'monitor',
-            'dashboard', 'admin', 'panel', 'console', 'manage', 'control',
-            'dev', 'staging', 'test', 'demo', 'preview', 'beta',
-            'us', 'eu', 'asia', 'jp', 'uk', 'de', 'fr', 'au', 'ca',
-            'east', 'west', 'north', 'south', 'central',
-            'lb', 'balancer', 'cache', 'dist', 'distribution', 'content',
-            'stream', 'live', 'vod', 'hls', 'rtmp', 'ws', 'wss',
-            'git', 'repo', 'registry', 'packages', 'npm', 'maven'
-        ]
-        
-        regions = ['us', 'eu', 'asia', 'east', 'west', 'north', 'south', 'central']
-        suffixes = ['srv', 'svc', 'service', 'host', 'server', 'cluster', 'net']
-        
-        domains = []
-        base_domain = self.config['domain']
-        
-        for i in range(count):
-            pattern = random.choice([
-                'prefix-hash', 'prefix-number', 'hash-only', 'prefix-region-num',
-                'service-suffix', 'multi-prefix', 'numbered-prefix'
-            ])
-            
-            if pattern == 'prefix-hash':
-                prefix = random.choice(service_prefixes)
-                hash_suffix = ''.join(random.choices(string.ascii_lowercase + string.digits, k=4))
-                subdomain = f"{prefix}-{hash_suffix}.{base_domain}"
-            
-            elif pattern == 'prefix-number':
-                prefix = random.choice(service_prefixes)
-                number = random.randint(1, 999)
-                subdomain = f"{prefix}{number}.{base_domain}"
-            
-            elif pattern == 'hash-only':
-                hash_str = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
-                subdomain = f"{hash_str}.{base_domain}"
-            
-            elif pattern == 'prefix-region-num':
-                prefix = random.choice(service_prefixes)
-                region = random.choice(regions)
-                number = random.randint(1, 99)
-                subdomain = f"{prefix}-{region}-{number:02d}.{base_domain}"
-            
-            elif pattern == 'service-suffix':
-                prefix = random.choice(service_prefixes)
-                suffix = random.choice(suffixes)
-                subdomain = f"{prefix}-{suffix}.{base_domain}"
-            
-            elif pattern == 'multi-prefix':
-                region = random.choice(regions)
-                service = random.choice(service_prefixes)
-                subdomain = f"{region}-{service}.{base_domain}"
-            
+    def zones(self) -> List[Zone]:
+        # "zones": [{"domain": ..., "zone_id": ...}, ...]; without it the
+        # single "domain" / "cloudflare.zone_id" pair
+        zones = self.config.get('zones')
+        if not zones:
+            return [Zone(self.config['domain'], self.config['cloudflare']['zone_id'])]
+        return [Zone(zone['domain'], zone['zone_id']) for zone in zones]
+
+    def origins(self) -> List[Origin]:
+        # "origin_ips": ["1.2.3.4", {"ip": "5.6.7.8", "weight": 2}, ...];
+        # weight 0 drains an origin while its records are still recognised
+        entries = self.config.get('origin_ips') or [self.config['origin_ip']]
+        origins = []
+        for entry in entries:
+            if isinstance(entry, dict):
+                origins.append(Origin(entry['ip'], float(entry.get('weight', 1))))
             else:
-                prefix = random.choice(service_prefixes)
-                number = random.randint(1, 99)
-                subdomain = f"{prefix}{number:02d}.{base_domain}"
-            
-            domains.append(subdomain)
-        
-        self.domains = domains
-        return domains
-    
-    def add_cloudflare_records(self) -> bool:
-        cf_token = self.config['cloudflare']['api_token']
-        zone_id = self.config['cloudflare']['zone_id']
-        origin_ip = self.config['origin_ip']
-        
-        headers = {
-            'Authorization': f'Bearer {cf_token}',
-            'Content-Type': 'application/json'
+                origins.append(Origin(entry, 1.0))
+        return origins
+
+    def origin_for(self, domain: str) -> str:
+        if self.ring is None:
+            self.ring = OriginRing(self.origins())
+        return self.ring.pick(domain)
+
+    def zone_for(self, domain: str) -> Optional[Zone]:
+        # Longest matching suffix, so nested zones resolve to the innermost
+        for zone in sorted(self.zones(), key=lambda zone: -len(zone.domain)):
+            if domain.endswith(f".{zone.domain}"):
+                return zone
+        return None
+
+    def group_by_zone(self, domains: Iterable[str]) -> Dict[Zone, List[str]]:
+        groups: Dict[Zone, List[str]] = {zone: [] for zone in self.zones()}
+        unmatched = 0
+        for domain in domains:
+            zone = self.zone_for(domain)
+            if zone is None:
+                unmatched += 1
+            else:
+                groups[zone].append(domain)
+        if unmatched:
+            print(f"Warning: {unmatched} domains belong to no configured zone, skipping those")
+        return groups
+
+    def iter_subdomains(self, count: int = 100, exclude: Iterable[str] = ()) -> Iterator[str]:
+        zones = self.zones()
+        if len(zones) == 1:
+            return SubdomainGenerator(zones[0].domain, self.seed, exclude).generate(count)
+        return self._iter_zone_subdomains(zones, count, exclude)
+
+    def _iter_zone_subdomains(self, zones: List[Zone], count: int, exclude: Iterable[str]) -> Iterator[str]:
+        # Round-robin so each zone carries an even share; a zone whose name
+        # space runs out drops out and the others absorb its share
+        exclude = set(exclude)
+        streams = [
+            SubdomainGenerator(zone.domain, None if self.seed is None else f"{self.seed}/{zone.domain}",
+                               exclude).generate(count)
+            for zone in zones
+        ]
+        produced = 0
+        while produced < count:
+            if not streams:
+                raise ValueError(f"Subdomain space exhausted after {produced} of {count} names")
+            for stream in list(streams):
+                if produced >= count:
+                    break
+                try:
+                    yield next(stream)
+                    produced += 1
+                except (StopIteration, ValueError):
+                    streams.remove(stream)
+
+    def generate_subdomains(self, count: int = 100) -> List[str]:
+        self.domains = list(self.iter_subdomains(count))
+        return self.domains
+
+    def cloudflare_client(self, zone: Optional[Zone] = None,
+                          limiter: Optional[TokenBucket] = None) -> CloudflareClient:
+        return CloudflareClient.from_config(self.config, zone.zone_id if zone else None, limiter, self.metrics)
+
+    def zone_clients(self) -> Dict[Zone, CloudflareClient]:
+        clients: Dict[Zone, CloudflareClient] = {}
+        limiter = None
+        for zone in self.zones():
+            client = self.cloudflare_client(zone, limiter)
+            limiter = client.limiter
+            clients[zone] = client
+        return clients
+
+    def record_payload(self, domain: str) -> Dict[str, Any]:
+        return {
+            'type': 'A',
+            'name': domain,
+            'content': self.origin_for(domain),
+            'ttl': 1,  # Auto
+            'proxied': True,  # Enable Cloudflare proxy
+            'comment': RECORD_COMMENT,
         }
-        
-        # Cloudflare v4 API lives under /client/v4 (missing segment yields 7000 No route)
-        base_url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records"
-        
+
+    def default_user(self) -> User:
+        # Resolved once: generate_xray_config and the subscription must agree
+        if self.default is None:
+            email = self.config.get('user_email', 'default@gfwmass')
+            user_id = self.config.get('user_id')
+            state = self.state_store()
+            if not user_id and state:
+                user_id = state.user(email)
+                if not user_id:
+                    user_id = str(uuid.uuid4())
+                    state.add_user(email, user_id)
+                    print(f"Generated user_id {user_id} for {email} (stored in {state.path})")
+            elif not user_id:
+                user_id = str(uuid.uuid4())
+                print(f"Warning: no user_id configured and state_db disabled; using {user_id} for this run only")
+            self.default = User(email, user_id)
+        return self.default
+
+    def load_users_file(self, path: str) -> List[User]:
+        # One user per line: "email [uuid]"; a missing UUID is generated
+        # once and kept in the state database
+        state = self.state_store()
+        users = []
+        with open(path) as f:
+            for line in f:
+                fields = line.split('#', 1)[0].split()
+                if not fields:
+                    continue
+                email = fields[0]
+                user_id = fields[1] if len(fields) > 1 else (state.user(email) if state else None)
+                if user_id is None:
+                    if state is None:
+                        print(f"Warning: {email} in {path} has no UUID and state_db is disabled, skipping")
+                        continue
+                    user_id = str(uuid.uuid4())
+                    state.add_user(email, user_id)
+                users.append(User(email, user_id))
+        return users
+
+    def users(self) -> List[User]:
+        # The default user, then users_file, then users added with
+        # --add-user; the first entry for an email wins
+        if self.user_cache is None:
+            users = [self.default_user()]
+            path = self.config.get('users_file')
+            if path and os.path.exists(path):
+                users.extend(self.load_users_file(path))
+            state = self.state_store()
+            if state:
+                users.extend(User(email, user_id) for email, user_id in state.users())
+            seen = set()
+            self.user_cache = []
+            for user in users:
+                if user.email not in seen:
+                    seen.add(user.email)
+                    self.user_cache.append(user)
+        return self.user_cache
+
+    def add_user(self, email: str, user_id: Optional[str] = None) -> User:
+        state = self.state_store()
+        if state is None:
+            raise ValueError("--add-user needs the state database (state_db is null); use users_file instead")
+        user = User(email, user_id or state.user(email) or str(uuid.uuid4()))
+        state.add_user(user.email, user.id)
+        self.user_cache = None
+        return user
+
+    def remove_user(self, email: str) -> bool:
+        state = self.state_store()
+        removed = bool(state and state.remove_user(email))
+        self.user_cache = None
+        return removed
+
+    def state_store(self) -> Optional[StateStore]:
+        # "state_db": null disables the store
+        path = self.config.get('state_db', 'gfwmass.db')
+        if self.state is None and path:
+            self.state = StateStore(path, self.config.get('checkpoint_every', 100))
+        return self.state
+
+    def artifacts(self) -> ArtifactStore:
+        if self.artifact_store is None:
+            self.artifact_store = ArtifactStore(self.config.get('manifest_file', '.gfwmass-manifest.json'))
+        return self.artifact_store
+
+    def abandon_deploy(self):
+        state = self.state_store()
+        if state:
+            state.abandon()
+
+    def resume_deploy(self) -> bool:
+        state = self.state_store()
+        deploy_id = state.interrupted_deploy() if state else None
+        if deploy_id is None:
+            return False
+        self.domains = state.deploy_domains(deploy_id)
+        return True
+
+    def add_cloudflare_records(self, resume: bool = False) -> bool:
+        clients = self.zone_clients()
+        state = self.state_store()
+        groups = self.group_by_zone(self.domains)
+
+        if state:
+            if resume:
+                # Records created after the last checkpoint exist in the zone
+                # but not in the store; adopt them instead of re-posting
+                wanted = set(self.domains)
+                try:
+                    for zone, index in self.fetch_zone_indexes(clients).items():
+                        state.upsert((records[0] for name, records in index.items() if name in wanted),
+                                     zone.zone_id)
+                except (RuntimeError, requests.RequestException) as e:
+                    print(f"Warning: could not index zone for resume ({e}); duplicates will be reported as failures")
+            else:
+                state.begin_deploy((name, zone.zone_id, self.origin_for(name))
+                                   for zone, names in groups.items() for name in names)
+            known = state.lookup(self.domains)
+            total = sum(len(names) for names in groups.values())
+            for zone, names in groups.items():
+                groups[zone] = [name for name in names if known.get(name, ('',))[0] != 'active']
+            done = total - sum(len(names) for names in groups.values())
+            if done:
+                print(f"Resuming: {done}/{total} records already provisioned")
+
+        batches = {}
+        spread: Dict[str, int] = {}
+        for zone, names in groups.items():
+            records = [self.record_payload(domain) for domain in names]
+            for record in records:
+                spread[record['content']] = spread.get(record['content'], 0) + 1
+            if records:
+                batches[zone] = clients[zone].apply(posts=records)
+        total = sum(spread.values())
+
         success_count = 0
         failed_count = 0
-        
-        print(f"Adding {len(self.domains)} DNS records to Cloudflare...")
-        
-        for i, domain in enumerate(self.domains):
-            data = {
-                'type': 'A',
-                'name': domain,
-                'content': origin_ip,
-                'ttl': 1,  # Auto
-                'proxied': True  # Enable Cloudflare proxy
-            }
-            
-            try:
-                response = requests.post(base_url, headers=headers, json=data)
-                if response.status_code in [200, 201]:
-                    success_count += 1
-                    if (i + 1) % 10 == 0:
-                        print(f"Progress: {i + 1}/{len(self.domains)} records added")
-                else:
-                    failed_count += 1
-                    print(f"Failed to add {domain}: {response.text}")
-            except Exception as e:
+
+        client = next(iter(clients.values()))
+        mode = f"batches of {client.batch_size}" if client.batch_size > 1 else "per-record"
+        print(f"Adding {total} DNS records to Cloudflare across {len(batches)} zone(s) "
+              f"({client.workers} workers per zone, {mode})...")
+        if len(spread) > 1:
+            print("Origins: " + ", ".join(f"{ip} x{n}" for ip, n in sorted(spread.items())))
+        started = time.monotonic()
+
+        for i, (zone, (_, record, result, error)) in enumerate(interleave(batches)):
+            if error is None:
+                success_count += 1
+                if state:
+                    state.record(record['name'], 'active', result.get('id'))
+            else:
                 failed_count += 1
-                print(f"Error adding {domain}: {str(e)}")
-        
+                print(f"Failed to add {record['name']}: {error}")
+                if state:
+                    state.record(record['name'], 'failed', error=error)
+            if (i + 1) % 10 == 0:
+                print(f"Progress: {i + 1}/{total} records processed")
+
+        elapsed = time.monotonic() - started
+        for client in clients.values():
+            client.close()
+        if state:
+            state.checkpoint()
+
+        rate = success_count / elapsed if elapsed > 0 else 0.0
         print(f"\nCompleted: {success_count} successful, {failed_count} failed")
+        print(f"Throughput: {rate:.1f} records/s over {elapsed:.1f}s")
         return failed_count == 0
 
-    def remove_cloudflare_records(self, domains: List[str]) -> bool:
-        cf_token = self.config['cloudflare']['api_token']
-        zone_id = self.config['cloudflare']['zone_id']
+    def fetch_zone_index(self, client: CloudflareClient) -> Dict[str, List[Dict[str, Any]]]:
+        # name -> A records, built from one paginated listing of the zone
+        page_size = self.config['cloudflare'].get('list_page_size', 1000)
+        index: Dict[str, List[Dict[str, Any]]] = {}
+        for record in client.list_records('A', page_size):
+            index.setdefault(record['name'], []).append(record)
+        return index
 
-        headers = {
-            'Authorization': f'Bearer {cf_token}',
-            'Content-Type': 'application/json'
-        }
+    def fetch_zone_indexes(self, clients: Dict[Zone, CloudflareClient]) -> Dict[Zone, Dict[str, List[Dict[str, Any]]]]:
+        with ThreadPoolExecutor(max_workers=len(clients)) as pool:
+            futures = {zone: pool.submit(self.fetch_zone_index, client) for zone, client in clients.items()}
+            return {zone: future.result() for zone, future in futures.items()}
+
+    def select_records(self, index: Dict[str, List[Dict[str, Any]]],
+                       domains: Optional[List[str]] = None,
+                       pattern: Optional[str] = None,
+                       origin_ip: Optional[str] = None) -> List[Dict[str, Any]]:
+        if domains is not None:
+            names = [name for name in dict.fromkeys(domains) if name in index]
+        else:
+            names = list(index)
+        if pattern:
+            names = [name for name in names if fnmatch.fnmatchcase(name, pattern)]
+
+        selected = []
+        for name in names:
+            for record in index[name]:
+                if origin_ip and record.get('content') != origin_ip:
+                    continue
+                selected.append(record)
+        return selected
+
+    def remove_cloudflare_records(self, domains: Optional[List[str]] = None,
+                                  pattern: Optional[str] = None,
+                                  origin_ip: Optional[str] = None) -> bool:
+        if domains is None and not pattern and not origin_ip:
+            print("Error: refusing to remove records without a domain list, pattern or origin IP")
+            return False
+
+        clients = self.zone_clients()
+        state = self.state_store()
 
-        base_url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records"
+        # Record ids saved by earlier deploys skip the zone listing entirely
+        records: Dict[Zone, List[Dict[str, Any]]] = {zone: [] for zone in clients}
+        unknown = domains
+        if state and domains is not None and not pattern and not origin_ip:
+            known = state.lookup(domains)
+            unknown = []
+            for name in dict.fromkeys(domains):
+                status, record_id = known.get(name, (None, None))
+                zone = self.zone_for(name)
+                if status == 'active' and record_id and zone is not None:
+                    records[zone].append({'id': record_id, 'name': name})
+                elif status != 'removed':
+                    unknown.append(name)
+            stored = sum(len(items) for items in records.values())
+            if stored:
+                print(f"Using {stored} record ids from {state.path}")
+
+        if unknown is None or unknown:
+            print(f"Indexing A records in {len(clients)} Cloudflare zone(s)...")
+            try:
+                indexes = self.fetch_zone_indexes(clients)
+            except (RuntimeError, requests.RequestException) as e:
+                print(f"Error: {e}")
+                for client in clients.values():
+                    client.close()
+                return False
+
+            for zone, index in indexes.items():
+                records[zone].extend(self.select_records(index, unknown, pattern, origin_ip))
+            if unknown is not None:
+                missing = sum(1 for name in set(unknown) if not any(name in index for index in indexes.values()))
+                if missing:
+                    print(f"No A record found for {missing} of {len(set(domains))} domains, skipping those")
 
         success_count = 0
         failed_count = 0
+        total = sum(len(items) for items in records.values())
 
-        print(f"Removing up to {len(domains)} DNS A records from Cloudflare...")
+        client = next(iter(clients.values()))
+        mode = f"batches of {client.batch_size}" if client.batch_size > 1 else "per-record"
+        print(f"Removing {total} DNS A records from Cloudflare ({client.workers} workers per zone, {mode})...")
 
-        for i, domain in enumerate(domains):
-            # Find the record id for this name/type
-            try:
-                list_resp = requests.get(
-                    base_url,
-                    headers=headers,
-                    params={"type": "A", "name": domain, "per_page": 1}
-                )
-                if list_resp.status_code != 200:
-                    failed_count += 1
-                    print(f"Failed to lookup {domain}: {list_resp.text}")
-                    continue
+        batches = {zone: clients[zone].apply(deletes=items) for zone, items in records.items() if items}
+        for i, (_, (_, record, _, error)) in enumerate(interleave(batches)):
+            # 81044: the stored id no longer exists, so the record is gone already
+            if error is None or error.startswith('81044'):
+                success_count += 1
+                if state:
+                    state.record(record['name'], 'removed')
+            else:
+                failed_count += 1
+                print(f"Failed to delete {record['name']}: {error}")
+            if (i + 1) % 10 == 0:
+                print(f"Progress: {i + 1}/{total} processed")
 
-                result = list_resp.json().get("result", [])
-                if not result:
-                    print(f"No A record found for {domain}, skipping")
-                    continue
+        for client in clients.values():
+            client.close()
+        if state:
+            state.checkpoint()
 
-                record_id = result[0].get("id")
-                if not record_id:
-                    failed_count += 1
-                    print(f"Missing record id for {domain}, skipping")
-                    continue
+        print(f"\nRemoval completed: {success_count} deleted, {failed_count} failed")
+        return failed_count == 0
 
-                del_resp = requests.delete(f"{base_url}/{record_id}", headers=headers)
-                if del_resp.status_code == 200:
-                    success_count += 1
-                    if (i + 1) % 10 == 0:
-                        print(f"Progress: {i + 1}/{len(domains)} processed")
-                else:
-                    failed_count += 1
-                    print(f"Failed to delete {domain}: {del_resp.text}")
-            except Exception as e:
+    def load_domains(self, path: str = 'domains.txt') -> List[str]:
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+
+    def write_domains(self, path: str, domains: Iterable[str]) -> int:
+        written = 0
+        with self.artifacts().open(path) as f:
+            for domain in domains:
+                f.write(f"{domain}\n")
+                written += 1
+        return written
+
+    def desired_domains(self, count: Optional[int] = None) -> List[str]:
+        # Keep the current domains.txt set, trimmed or topped up to count
+        domains = list(dict.fromkeys(self.load_domains()))
+        if count is None:
+            count = len(domains) or 100
+        domains = domains[:count]
+
+        if len(domains) < count:
+            domains.extend(self.iter_subdomains(count - len(domains), exclude=domains))
+
+        self.domains = domains
+        return domains
+
+    def plan_sync(self, index: Dict[str, List[Dict[str, Any]]], domains: List[str],
+                  zone: Optional[Zone] = None, known: Iterable[str] = ()) -> Dict[str, List[Dict[str, Any]]]:
+        zone = zone or self.zones()[0]
+        ours = {origin.ip for origin in self.origins()}
+        suffix = f".{zone.domain}"
+        desired = set(domains)
+        plan: Dict[str, List[Dict[str, Any]]] = {'create': [], 'update': [], 'delete': [], 'unchanged': []}
+
+        for domain in domains:
+            records = index.get(domain, [])
+            if not records:
+                plan['create'].append(self.record_payload(domain))
+                continue
+            origin_ip = self.origin_for(domain)
+            keep = next((r for r in records if r.get('content') == origin_ip and r.get('proxied')), None)
+            if keep is None:
+                keep = records[0]
+                plan['update'].append({'id': keep['id'], 'name': domain, 'content': origin_ip, 'proxied': True,
+                                       'comment': RECORD_COMMENT})
+            else:
+                plan['unchanged'].append(keep)
+            plan['delete'].extend(r for r in records if r is not keep)
+
+        # Only records we created are ours to delete: tagged with our
+        # comment, or (for records from before tagging) named in the state
+        # database. Both must still point at one of our origins.
+        known = set(known)
+        for name, records in index.items():
+            if name in desired or not name.endswith(suffix):
+                continue
+            plan['delete'].extend(r for r in records if r.get('content') in ours and
+                                  (r.get('comment') == RECORD_COMMENT or name in known))
+
+        return plan
+
+    def print_sync_plan(self, plan: Dict[str, List[Dict[str, Any]]], limit: int = 10):
+        print(f"Sync plan: {len(plan['create'])} to create, {len(plan['update'])} to update, "
+              f"{len(plan['delete'])} to delete, {len(plan['unchanged'])} unchanged")
+        for action, symbol in (('create', '+'), ('update', '~'), ('delete', '-')):
+            for item in plan[action][:limit]:
+                print(f"  {symbol} {item['name']}")
+            if len(plan[action]) > limit:
+                print(f"  {symbol} ... and {len(plan[action]) - limit} more")
+
+    def sync_cloudflare_records(self, dry_run: bool = False) -> bool:
+        clients = self.zone_clients()
+
+        print(f"Indexing A records in {len(clients)} Cloudflare zone(s)...")
+        try:
+            indexes = self.fetch_zone_indexes(clients)
+        except (RuntimeError, requests.RequestException) as e:
+            print(f"Error: {e}")
+            for client in clients.values():
+                client.close()
+            return False
+
+        groups = self.group_by_zone(self.domains)
+        state = self.state_store()
+        known = state.names() if state else set()
+        plans = {zone: self.plan_sync(indexes[zone], groups[zone], zone, known) for zone in clients}
+        plan: Dict[str, List[Dict[str, Any]]] = {
+            action: [item for zone_plan in plans.values() for item in zone_plan[action]]
+            for action in ('create', 'update', 'delete', 'unchanged')
+        }
+        self.print_sync_plan(plan)
+
+        total = len(plan['create']) + len(plan['update']) + len(plan['delete'])
+        if dry_run or total == 0:
+            for client in clients.values():
+                client.close()
+            print("\nDry run: no changes applied" if dry_run else "\nZone already in sync")
+            return True
+
+        if state:
+            state.begin_deploy((name, zone.zone_id, self.origin_for(name))
+                               for zone, names in groups.items() for name in names)
+            for zone, zone_plan in plans.items():
+                state.upsert(zone_plan['unchanged'], zone.zone_id)
+
+        success_count = 0
+        failed_count = 0
+        started = time.monotonic()
+
+        batches = {
+            zone: clients[zone].apply(posts=zone_plan['create'], patches=zone_plan['update'],
+                                      deletes=zone_plan['delete'])
+            for zone, zone_plan in plans.items()
+            if zone_plan['create'] or zone_plan['update'] or zone_plan['delete']
+        }
+        for i, (_, (op, record, result, error)) in enumerate(interleave(batches)):
+            if error is None:
+                success_count += 1
+                if state:
+                    if op == 'delete':
+                        state.record(record['name'], 'removed')
+                    else:
+                        state.record(record['name'], 'active', result.get('id'))
+            else:
                 failed_count += 1
-                print(f"Error removing {domain}: {str(e)}")
+                print(f"Failed to {op} {record['name']}: {error}")
+                if state and op != 'delete':
+                    state.record(record['name'], 'failed', error=error)
+            if (i + 1) % 10 == 0:
+                print(f"Progress: {i + 1}/{total} changes applied")
 
-        print(f"\nRemoval completed: {success_count} deleted, {failed_count} failed or skipped")
+        elapsed = time.monotonic() - started
+        for client in clients.values():
+            client.close()
+        if state:
+            state.checkpoint()
+
+        print(f"\nSync completed: {success_count} changes applied, {failed_count} failed in {elapsed:.1f}s")
         return failed_count == 0
-    
+
+    def xray_instances(self) -> List[Dict[str, Any]]:
+        # One Xray process per worker; a single worker keeps the stock
+        # xray.service and config.json, more use the xray@ template unit
+        workers = max(1, self.config.get('workers', 1))
+        xray_port = self.config.get('xray_port', 10000)
+        api_port = self.config.get('xray_api_port', 10085)
+        if workers == 1:
+            instances = [{
+                'index': 0,
+                'port': xray_port,
+                'file': 'xray_config.json',
+                'path': '/usr/local/etc/xray/config.json',
+                'service': 'xray',
+                'socket': 'xray.sock',
+            }]
+        else:
+            instances = [
+                {
+                    'index': i,
+                    'port': xray_port + i,
+                    'file': f'xray_config_{i}.json',
+                    'path': f'/usr/local/etc/xray/gfwmass-{i}.json',
+                    'service': f'xray@gfwmass-{i}',
+                    'socket': f'xray-{i}.sock',
+                }
+                for i in range(workers)
+            ]
+
+        # Caddy -> Xray hop: loopback TCP, or a Unix socket to skip the TCP
+        # stack and ephemeral port churn
+        socket_dir = self.config.get('xray_socket_dir', '/run/gfwmass')
+        for instance in instances:
+            instance['api'] = f"127.0.0.1:{api_port + instance['index']}"
+            if self.config.get('xray_transport', 'tcp') == 'unix':
+                instance['socket'] = f"{socket_dir}/{instance['socket']}"
+                instance['upstream'] = f"unix/{instance['socket']}"
+            else:
+                instance['socket'] = None
+                instance['upstream'] = f"localhost:{instance['port']}"
+        return instances
+
+    def zone_cert_paths(self, zone: Zone) -> Tuple[str, str]:
+        # The first zone uses manual_cert_path/manual_key_path; others get a
+        # per-domain directory unless their "zones" entry names the files
+        for entry in self.config.get('zones') or []:
+            if entry['domain'] == zone.domain and entry.get('cert_path'):
+                return entry['cert_path'], entry['key_path']
+        if zone == self.zones()[0]:
+            return (self.config.get('manual_cert_path', '/etc/ssl/gfwmass/fullchain.pem'),
+                    self.config.get('manual_key_path', '/etc/ssl/gfwmass/privkey.pem'))
+        return f"/etc/ssl/gfwmass/{zone.domain}/fullchain.pem", f"/etc/ssl/gfwmass/{zone.domain}/privkey.pem"
+
     def generate_caddy_config(self) -> str:
         email = self.config.get('email', 'admin@example.com')
-        xray_port = self.config.get('xray_port', 10000)
-        base_domain = self.config['domain']
-        cert_path = self.config.get('manual_cert_path', '/etc/ssl/gfwmass/fullchain.pem')
-        key_path = self.config.get('manual_key_path', '/etc/ssl/gfwmass/privkey.pem')
 
         # Global options with email
         config = f"""{{
@@ -217,19 +2258,39 @@ class GFWMass:
 
 """
 
+        upstreams = ' '.join(instance['upstream'] for instance in self.xray_instances())
+        # Without a delay a config reload closes every proxied WebSocket
+        options = [f"stream_close_delay {self.config.get('caddy_stream_close_delay', '5m')}"]
+        if ' ' in upstreams:
+            # Sticky per real client: behind Cloudflare the peer IP is an edge node
+            options.append(f"lb_policy {self.config.get('lb_policy', 'header CF-Connecting-IP')}")
+        profile = self.tuning_profile()
+        encode = "encode gzip"
+        if profile:
+            # Tunnels are opaque bytes: flush every write instead of batching,
+            # and keep compression to the rest of the site
+            options.append("flush_interval -1")
+            transport = ''.join(f"            {key} {value}\n" for key, value in profile['transport'].items())
+            options.append("transport http {\n" + transport + "        }")
+            encode = "@compressible not path /ws*\n    encode @compressible gzip"
+        proxy = f"reverse_proxy {upstreams} {{\n" + ''.join(f"        {option}\n" for option in options) + "    }"
+
         # Manual DNS-01: user supplies cert/key generated via certbot (DNS challenge)
-        config += f"""*.{base_domain} {{
-    reverse_proxy localhost:{xray_port}
+        sites = []
+        for zone in self.zones():
+            cert_path, key_path = self.zone_cert_paths(zone)
+            sites.append(f"""*.{zone.domain} {{
+    {proxy}
     tls {cert_path} {key_path}
-    encode gzip
+    {encode}
 }}
-"""
+""")
+        config += '\n'.join(sites)
 
         return config
     
-    def generate_xray_config(self) -> Dict[str, Any]:
-        user_id = self.config.get('user_id', str(uuid.uuid4()))
-        port = self.config.get('xray_port', 10000)
+    def generate_xray_config(self, worker: int = 0) -> Dict[str, Any]:
+        instance = self.xray_instances()[worker]
         
         config = {
             "log": {
@@ -237,14 +2298,13 @@ class GFWMass:
             },
             "inbounds": [
                 {
-                    "port": port,
+                    "tag": XRAY_INBOUND_TAG,
+                    "port": instance['port'],
                     "protocol": "vless",
                     "settings": {
                         "clients": [
-                            {
-                                "id": user_id,
-                                "level": 0
-                            }
+                            {"id": user.id, "email": user.email, "level": 0}
+                            for user in self.users()
                         ],
                         "decryption": "none"
                     },
@@ -264,110 +2324,704 @@ class GFWMass:
                 }
             ]
         }
+
+        profile = self.tuning_profile()
+        if profile:
+            # Clients are all level 0, so one policy level covers them
+            config["policy"] = {"levels": {"0": dict(profile['policy'])}}
+            outbound = config["outbounds"][0]
+            outbound["settings"]["domainStrategy"] = profile['domain_strategy']
+            outbound["streamSettings"] = {"sockopt": dict(profile['sockopt'])}
+
+        inbound = config["inbounds"][0]
+        if instance['socket']:
+            # Xray takes the socket file mode after a comma; 0666 lets Caddy connect
+            del inbound["port"]
+            mode = self.config.get('xray_socket_mode', '0666')
+            inbound["listen"] = f"{instance['socket']},{mode}"
+
+        if self.config.get('xray_api', True):
+            # Loopback-only gRPC API: HandlerService lets deploys add and
+            # remove clients without restarting Xray
+            api_host, _, api_port = instance['api'].rpartition(':')
+            config["api"] = {"tag": XRAY_API_TAG, "services": ["HandlerService", "StatsService"]}
+            config["inbounds"].append({
+                "tag": XRAY_API_TAG,
+                "listen": api_host,
+                "port": int(api_port),
+                "protocol": "dokodemo-door",
+                "settings": {"address": api_host}
+            })
+            config["routing"] = {
+                "rules": [{"type": "field", "inboundTag": [XRAY_API_TAG], "outboundTag": XRAY_API_TAG}]
+            }
         
         return config
     
-    def generate_subscription(self) -> str:
-        user_id = self.config.get('user_id', str(uuid.uuid4()))
-        
-        links = []
-        for domain in self.domains:
-            link = (
-                f"vless://{user_id}@{domain}:443?encryption=none&security=tls"
-                f"&type=ws&host={domain}&path=/ws#{domain}"
-            )
-            links.append(link)
-        
-        subscription_content = '\n'.join(links)
+    def subscription_domains(self, domains: Optional[Iterable[str]] = None,
+                             origin: Optional[str] = None) -> Iterable[str]:
+        domains = self.domains if domains is None else domains
+        if origin is not None:
+            domains = (domain for domain in domains if self.origin_for(domain) == origin)
+        probe = self.config.get('probe', {})
+        if probe.get('sort_subscription') or probe.get('max_latency_ms'):
+            domains = self.rank_domains(domains)
+        return domains
+
+    def iter_subscription_links(self, domains: Optional[Iterable[str]] = None,
+                                origin: Optional[str] = None) -> Iterator[str]:
+        user_id = self.default_user().id
+        for domain in self.subscription_domains(domains, origin):
+            yield LINK_TEMPLATE.format(user_id=user_id, domain=domain)
+
+    def user_subscription_path(self, user: User) -> str:
+        directory = self.config.get('user_subscription_dir', 'subscriptions')
+        name = ''.join(c if c.isalnum() or c in '@._-' else '_' for c in user.email)
+        if name != user.email:
+            # Replacing characters can map two emails to one name: tag it
+            # with the email's hash, after a "~" no untouched name contains
+            name += '~' + hashlib.sha256(user.email.encode()).hexdigest()[:12]
+        return os.path.join(directory, f"{name}.txt")
+
+    def write_user_subscriptions(self, users: Optional[List[User]] = None) -> Tuple[int, int]:
+        # Every user's file is keyed by (link template, UUID): unchanged
+        # users are skipped without rendering, so adding one user renders
+        # one file. Renders run on a thread pool, one user in memory per
+        # worker, and files of users no longer registered are removed.
+        users = self.users() if users is None else users
+        directory = self.config.get('user_subscription_dir', 'subscriptions')
+        os.makedirs(directory, exist_ok=True)
+        store = self.artifacts()
+        template = LinkTemplate(self.subscription_domains())
+
+        def render(user: User) -> bool:
+            path = self.user_subscription_path(user)
+            key = f"{template.digest}:{user.id}"
+            if store.fresh(path, key):
+                return False
+            with store.open(path, key) as f:
+                f.write(base64.b64encode(template.render(user.id)))
+            return True
+
+        workers = self.config.get('render_workers', min(32, (os.cpu_count() or 1) * 2))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            rendered = sum(pool.map(render, users))
+
+        # Only remove files rendered here: the directory may hold others
+        expected = {os.path.normpath(self.user_subscription_path(user)) for user in users}
+        for path in store.rendered_in(directory):
+            if os.path.normpath(path) not in expected:
+                if os.path.exists(path):
+                    os.unlink(path)
+                store.forget(path)
+        return rendered, len(users) - rendered
+
+    def load_probe_results(self) -> Dict[str, Dict[str, Any]]:
+        path = self.config.get('probe', {}).get('results_file', 'probe_results.json')
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as f:
+            return json.load(f).get('domains', {})
+
+    def rank_domains(self, domains: Iterable[str]) -> List[str]:
+        # Fastest measured first; failed or too slow endpoints dropped;
+        # domains never probed go last in their original order
+        probe = self.config.get('probe', {})
+        results = self.load_probe_results()
+        max_latency = probe.get('max_latency_ms')
+        drop_failed = probe.get('drop_failed', True)
+
+        measured = []
+        unmeasured = []
+        for domain in domains:
+            result = results.get(domain)
+            if result is None:
+                unmeasured.append(domain)
+            elif not result.get('ok'):
+                if not drop_failed:
+                    unmeasured.append(domain)
+            elif max_latency and result['total_ms']['p50'] > max_latency:
+                continue
+            else:
+                measured.append((result['total_ms']['p50'], domain))
+
+        if probe.get('sort_subscription'):
+            measured.sort()
+        return [domain for _, domain in measured] + unmeasured
+
+    def generate_subscription(self, domains: Optional[Iterable[str]] = None,
+                              origin: Optional[str] = None) -> str:
+        subscription_content = '\n'.join(self.iter_subscription_links(domains, origin))
         encoded = base64.b64encode(subscription_content.encode()).decode()
         
         return encoded
+
+    def write_subscription(self, domains: Optional[Iterable[str]] = None,
+                           encoded_path: str = 'subscription.txt',
+                           plain_path: str = 'subscription_decoded.txt',
+                           origin: Optional[str] = None) -> int:
+        # One pass over the links: the plain file is written as we go and the
+        # base64 file is encoded in 3-byte aligned chunks, so only one chunk
+        # is ever held in memory
+        pending = bytearray()
+        count = 0
+        store = self.artifacts()
+        with store.open(plain_path) as plain, store.open(encoded_path) as encoded:
+            for link in self.iter_subscription_links(domains, origin):
+                line = (b'\n' if count else b'') + link.encode()
+                plain.write(line)
+                pending += line
+                count += 1
+                if len(pending) >= SUBSCRIPTION_CHUNK:
+                    aligned = len(pending) - len(pending) % 3
+                    encoded.write(base64.b64encode(pending[:aligned]))
+                    del pending[:aligned]
+            encoded.write(base64.b64encode(pending))
+        return count
     
-    def save_configs(self):
-        caddy_config = self.generate_caddy_config()
-        with open('Caddyfile', 'w') as f:
-            f.write(caddy_config)
-        print("✓ Caddyfile generated")
-        
-        xray_config = self.generate_xray_config()
-        with open('xray_config.json', 'w') as f:
-            json.dump(xray_config, f, indent=2)
-        print("✓ xray_config.json generated")
-        
-        with open('domains.txt', 'w') as f:
-            f.write('\n'.join(self.domains))
-        print("✓ domains.txt generated")
+    async def _probe_once(self, domain: str, options: Dict[str, Any],
+                          context: ssl.SSLContext) -> Dict[str, float]:
+        loop = asyncio.get_running_loop()
+        port = options.get('port', 443)
+        host = domain
+        if options.get('connect'):
+            # Test against a local stand-in: resolve/connect there, but keep
+            # the domain for SNI and Host
+            host, _, port_text = options['connect'].rpartition(':')
+            port = int(port_text)
+        timeout = options.get('timeout', 5)
+        path = options.get('path', '/ws')
+
+        started = time.perf_counter()
+        infos = await asyncio.wait_for(loop.getaddrinfo(host, port, type=socket.SOCK_STREAM), timeout)
+        resolved = time.perf_counter()
+
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(infos[0][4][0], port, ssl=context, server_hostname=domain),
+            timeout)
+        connected = time.perf_counter()
+        try:
+            key = base64.b64encode(os.urandom(16)).decode()
+            writer.write((
+                f"GET {path} HTTP/1.1\r\nHost: {domain}\r\nUpgrade: websocket\r\n"
+                f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n"
+            ).encode())
+            await writer.drain()
+            status = await asyncio.wait_for(reader.readline(), timeout)
+            upgraded = time.perf_counter()
+        finally:
+            writer.close()
+
+        parts = status.decode(errors='replace').split()
+        if len(parts) < 2 or parts[1] != '101':
+            raise RuntimeError(f"WebSocket upgrade failed: {status.decode(errors='replace').strip() or 'no response'}")
+
+        return {
+            'dns': (resolved - started) * 1000,
+            'tls': (connected - resolved) * 1000,
+            'ws': (upgraded - connected) * 1000,
+            'total': (upgraded - started) * 1000,
+        }
+
+    async def _probe_all(self, domains: List[str], options: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        semaphore = asyncio.Semaphore(options.get('concurrency', 100))
+
+        # Built once: loading the CA store per handshake would stall the loop
+        context = ssl.create_default_context()
+        if not options.get('verify', True):
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+
+        samples: Dict[str, List[Dict[str, float]]] = {domain: [] for domain in domains}
+        errors: Dict[str, List[str]] = {domain: [] for domain in domains}
+
+        async def run(domain: str):
+            async with semaphore:
+                try:
+                    samples[domain].append(await self._probe_once(domain, options, context))
+                except (OSError, asyncio.TimeoutError, ssl.SSLError, RuntimeError) as e:
+                    errors[domain].append(str(e) or type(e).__name__)
+
+        for _ in range(options.get('rounds', 3)):
+            await asyncio.gather(*(run(domain) for domain in domains))
+
+        results = {}
+        for domain in domains:
+            result: Dict[str, Any] = {
+                'ok': bool(samples[domain]),
+                'samples': len(samples[domain]),
+                'errors': len(errors[domain]),
+            }
+            for step in ('dns', 'tls', 'ws', 'total'):
+                values = [sample[step] for sample in samples[domain]]
+                result[f'{step}_ms'] = {p: round(percentile(values, q), 2)
+                                        for p, q in (('p50', 50), ('p90', 90), ('p99', 99))}
+            if errors[domain]:
+                result['last_error'] = errors[domain][-1]
+            results[domain] = result
+        return results
+
+    def probe_domains(self, domains: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        options = self.config.get('probe', {})
+        domains = self.domains if domains is None else domains
+        path = options.get('results_file', 'probe_results.json')
+
+        print(f"Probing {len(domains)} domains (DNS, TLS, WebSocket {options.get('path', '/ws')}), "
+              f"{options.get('rounds', 3)} rounds, concurrency {options.get('concurrency', 100)}...")
+        started = time.monotonic()
+        results = asyncio.run(self._probe_all(domains, options))
+        elapsed = time.monotonic() - started
+
+        with open(path, 'w') as f:
+            json.dump({'probed_at': int(time.time()), 'domains': results}, f, indent=2)
+
+        healthy = [r['total_ms']['p50'] for r in results.values() if r['ok']]
+        print(f"✓ {len(healthy)} healthy, {len(results) - len(healthy)} failed in {elapsed:.1f}s")
+        if healthy:
+            print(f"Latency across healthy domains: p50 {percentile(healthy, 50):.0f} ms, "
+                  f"p99 {percentile(healthy, 99):.0f} ms")
+        print(f"✓ {path} written")
+        return results
+
+    def write_origin_subscriptions(self) -> Dict[str, int]:
+        # One subscription per origin, so a client can be pinned to a box
+        groups: Dict[str, List[str]] = {origin.ip: [] for origin in self.origins()}
+        for domain in self.domains:
+            groups.setdefault(self.origin_for(domain), []).append(domain)
+        counts = {
+            ip: self.write_subscription(domains, f"subscription-{ip}.txt", f"subscription-{ip}_decoded.txt")
+            for ip, domains in groups.items()
+        }
+        self.prune_origin_subscriptions(counts)
+        return counts
+
+    def prune_origin_subscriptions(self, ips: Iterable[str] = ()):
+        # Files of origins dropped from origin_ips would keep serving a stale
+        # list; only files recorded in the manifest are touched
+        keep = set()
+        for ip in ips:
+            keep.update((f"subscription-{ip}.txt", f"subscription-{ip}_decoded.txt"))
+        store = self.artifacts()
+        for path in store.unkeyed('subscription-*.txt'):
+            if path not in keep:
+                if os.path.exists(path):
+                    os.unlink(path)
+                store.forget(path)
+
+    def print_status(self):
+        state = self.state_store()
+        if state is None:
+            print("State database disabled (state_db is null)")
+            return
+        counts = state.counts()
+        print(f"State: {state.path}")
+        for status in ('active', 'pending', 'rotating', 'failed', 'removed'):
+            print(f"  {status:<8} {counts.get(status, 0)}")
+        failures = state.failures()
+        if failures:
+            print("Recent failures:")
+            for name, error in failures:
+                print(f"  {name}: {error}")
+
+    def subscription_server(self, listen: Optional[str] = None) -> SubscriptionServer:
+        options = self.config.get('subscription_server', {})
+        host = options.get('host', '127.0.0.1')
+        port = options.get('port', 8080)
+        if listen:
+            host, _, port_text = listen.rpartition(':')
+            host = host or '0.0.0.0'
+            port = int(port_text)
+        cache = SubscriptionCache(
+            self,
+            options.get('domains_file', 'domains.txt'),
+            shard_size=options.get('shard_size', 0),
+            probe_path=self.config.get('probe', {}).get('results_file', 'probe_results.json'),
+        )
+        cache.refresh()
+        return SubscriptionServer((host, port), cache, options.get('path', '/sub'), options.get('tokens'))
+
+    def serve_subscription(self, listen: Optional[str] = None):
+        server = self.subscription_server(listen)
+        host, port = server.server_address[:2]
+        shard = server.cache.shard_size
+        print(f"Serving {len(server.cache.domains)} endpoints on http://{host}:{port}{server.path}")
+        if shard:
+            print(f"Per-client shards of {shard} domains at {server.path.rstrip('/')}/<token>")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    def run_daemon(self, cycles: Optional[int] = None, listen: Optional[str] = None,
+                   clock: Optional[Clock] = None):
+        daemon = RotationDaemon(self, clock)
+        server = None
+        if listen:
+            # Same process serves the subscription; the cache re-reads
+            # domains.txt when a rotation rewrites it
+            server = self.subscription_server(listen)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            host, port = server.server_address[:2]
+            print(f"Serving the rotating subscription on http://{host}:{port}{server.path}")
+        # systemd stops the unit with SIGTERM: unwind like Ctrl-C so the
+        # state store and metrics are flushed
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            daemon.run(cycles)
+        except KeyboardInterrupt:
+            print("\nRotation daemon stopped")
+        finally:
+            if server:
+                server.shutdown()
+                server.server_close()
+
+    def write_subscriptions(self) -> int:
+        # Everything derived from the domain list; the Caddyfile and Xray
+        # configs only depend on zones and users, so rotations stop here.
+        # Returns the endpoints in subscription.txt
+        self.write_domains('domains.txt', self.domains)
+        count = self.write_subscription()
+        if self.config.get('subscription_groups') == 'origin':
+            self.write_origin_subscriptions()
+        else:
+            self.prune_origin_subscriptions()
+        if len(self.users()) > 1 or os.path.isdir(self.config.get('user_subscription_dir', 'subscriptions')):
+            rendered, skipped = self.write_user_subscriptions()
+            print(f"✓ Per-user subscriptions: {rendered} rendered, {skipped} unchanged")
+        return count
+
+    def save_configs(self) -> List[str]:
+        store = self.artifacts()
+        with store.open('Caddyfile') as f:
+            f.write(self.generate_caddy_config())
         
-        subscription = self.generate_subscription()
-        with open('subscription.txt', 'w') as f:
-            f.write(subscription)
-        print("✓ subscription.txt generated (base64 encoded)")
+        for instance in self.xray_instances():
+            xray_config = self.generate_xray_config(instance['index'])
+            with store.open(instance['file']) as f:
+                f.write(json.dumps(xray_config, indent=2))
         
-        with open('subscription_decoded.txt', 'w') as f:
-            decoded = base64.b64decode(subscription).decode()
-            f.write(decoded)
-        print("✓ subscription_decoded.txt generated (human readable)")
-
+        self.write_subscriptions()
         self.write_manual_dns_instructions()
+        store.save()
+
+        # Per-user files are summarised above rather than listed
+        user_dir = os.path.join(self.config.get('user_subscription_dir', 'subscriptions'), '')
+        for path in store.changed:
+            if not path.startswith(user_dir):
+                print(f"✓ {path} generated")
+        unchanged = [path for path in store.unchanged if not path.startswith(user_dir)]
+        if unchanged:
+            print(f"✓ {len(unchanged)} unchanged: {', '.join(unchanged)}")
+        return store.changed
     
-    def install_dependencies(self):
+    @staticmethod
+    def installed_version(command: List[str]) -> Optional[str]:
+        if shutil.which(command[0]) is None:
+            return None
+        try:
+            proc = subprocess.run(command, capture_output=True, text=True, timeout=15)
+        except (OSError, subprocess.SubprocessError):
+            return None
+        if proc.returncode != 0:
+            return None
+        output = (proc.stdout or proc.stderr).strip()
+        return output.splitlines()[0] if output else 'unknown version'
+
+    def installed_versions(self) -> Dict[str, Optional[str]]:
+        with ThreadPoolExecutor(max_workers=len(DEPENDENCY_VERSION_COMMANDS)) as pool:
+            futures = {name: pool.submit(self.installed_version, command)
+                       for name, command in DEPENDENCY_VERSION_COMMANDS.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    def install_dependencies(self, force: bool = False):
         print("\n=== Installing Dependencies ===\n")
 
         if os.geteuid() != 0:
             print("Warning: Not running as root. You may need sudo privileges.")
 
-        print("Installing stock Caddy (no DNS provider modules) and Xray...")
-        install_cmds = [
-            "apt update",
-            "apt install -y debian-keyring debian-archive-keyring apt-transport-https",
-            "curl -1sLf 'https://dl.cloudsmith.io/public/caddy/stable/gpg.key' | sudo gpg --dearmor -o /usr/share/keyrings/caddy-stable-archive-keyring.gpg",
-            "curl -1sLf 'https://dl.cloudsmith.io/public/caddy/stable/debian.deb.txt' | sudo tee /etc/apt/sources.list.d/caddy-stable.list",
-            "apt update",
-            "apt install -y caddy",
-            "apt install -y certbot"
-        ]
+        versions = {name: None for name in DEPENDENCY_VERSION_COMMANDS} if force else self.installed_versions()
+        for name, version in versions.items():
+            if version:
+                print(f"✓ {name} already installed: {version}")
+        missing = [name for name, version in versions.items() if not version]
+        if not missing:
+            print("\n✓ All dependencies already installed, nothing to do (use --reinstall to force)")
+            return
+
+        packages = [name for name in ('caddy', 'certbot') if name in missing]
+        install_cmds = []
+        if 'caddy' in missing and (force or not os.path.exists(CADDY_APT_SOURCE)):
+            print("Installing stock Caddy (no DNS provider modules)...")
+            install_cmds += [
+                "apt update",
+                "apt install -y debian-keyring debian-archive-keyring apt-transport-https",
+                "curl -1sLf 'https://dl.cloudsmith.io/public/caddy/stable/gpg.key' | sudo gpg --batch --yes --dearmor -o /usr/share/keyrings/caddy-stable-archive-keyring.gpg",
+                f"curl -1sLf 'https://dl.cloudsmith.io/public/caddy/stable/debian.deb.txt' | sudo tee {CADDY_APT_SOURCE}",
+                # Only the new source needs fetching; the rest was refreshed above
+                f"apt update -o Dir::Etc::sourcelist={CADDY_APT_SOURCE} "
+                "-o Dir::Etc::sourceparts=- -o APT::Get::List-Cleanup=0",
+            ]
+        elif packages:
+            install_cmds.append("apt update")
+        if packages:
+            install_cmds.append(f"apt install -y {' '.join(packages)}")
+
         for cmd in install_cmds:
             try:
                 subprocess.run(cmd, shell=True, check=True)
             except subprocess.CalledProcessError as e:
                 print(f"Warning: Command failed: {cmd} - {e}")
 
-        print("\nInstalling Xray...")
-        xray_install_cmd = "bash -c \"$(curl -L https://github.com/XTLS/Xray-install/raw/main/install-release.sh)\" @ install"
-        try:
-            subprocess.run(xray_install_cmd, shell=True, check=True)
-        except subprocess.CalledProcessError:
-            print("Warning: Xray installation may have failed. Please install manually if needed.")
+        if 'xray' in missing:
+            print("\nInstalling Xray...")
+            xray_install_cmd = "bash -c \"$(curl -L https://github.com/XTLS/Xray-install/raw/main/install-release.sh)\" @ install"
+            try:
+                subprocess.run(xray_install_cmd, shell=True, check=True)
+            except subprocess.CalledProcessError:
+                print("Warning: Xray installation may have failed. Please install manually if needed.")
 
         print("\n✓ Dependencies installation completed")
     
-    def deploy_configs(self):
+    def prepare_socket_dir(self):
+        socket_dir = self.config.get('xray_socket_dir', '/run/gfwmass')
+        owner = self.config.get('xray_socket_owner', 'nobody')
+
+        # /run is a tmpfs: let systemd-tmpfiles recreate the directory at boot
+        tmpfiles_path = "/etc/tmpfiles.d/gfwmass.conf"
+        try:
+            with open(tmpfiles_path, 'w') as f:
+                f.write(f"d {socket_dir} 0755 {owner} - -\n")
+            subprocess.run(f"systemd-tmpfiles --create {tmpfiles_path}", shell=True, check=True)
+            print(f"✓ Socket directory {socket_dir} created (owner {owner}, persisted via {tmpfiles_path})")
+        except (OSError, subprocess.CalledProcessError):
+            print(f"Warning: Failed to create {socket_dir}. Create it manually, writable by the Xray user ({owner}).")
+
+    def deploy_targets(self) -> List[Tuple[str, str, str, Optional[str]]]:
+        # (artifact, installed path, service that reads it, Xray API address)
+        targets = [("Caddyfile", CADDYFILE_PATH, "caddy", None)]
+        for instance in self.xray_instances():
+            targets.append((instance['file'], instance['path'], instance['service'], instance['api']))
+        return targets
+
+    @staticmethod
+    def read_json(path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def split_clients(config: Dict[str, Any]) -> Tuple[str, Dict[Tuple[str, str], Dict[str, Any]]]:
+        # The config minus its client lists (what a restart would change),
+        # and the clients keyed by (inbound tag, email)
+        topology = json.loads(json.dumps(config))
+        clients = {}
+        for inbound in topology.get('inbounds', []):
+            for client in (inbound.get('settings') or {}).pop('clients', None) or []:
+                clients[(inbound.get('tag') or '', client.get('email') or '')] = client
+        return json.dumps(topology, sort_keys=True), clients
+
+    def plan_change(self, service: str, api: Optional[str],
+                    previous: Optional[Dict[str, Any]], current: Dict[str, Any]) -> ServiceChange:
+        if api is None:
+            return ServiceChange(service, None, [], [], False)
+        if previous is None or not self.config.get('xray_api', True):
+            return ServiceChange(service, api, [], [], True)
+
+        old_topology, old_clients = self.split_clients(previous)
+        new_topology, new_clients = self.split_clients(current)
+        # Clients can only be removed by email, and only on tagged inbounds
+        if old_topology != new_topology or any(not tag or not email for tag, email in old_clients):
+            return ServiceChange(service, api, [], [], True)
+
+        removed = [key for key, client in old_clients.items() if new_clients.get(key) != client]
+        added: Dict[str, Dict[str, Any]] = {}
+        for inbound in current.get('inbounds', []):
+            tag = inbound.get('tag') or ''
+            for client in (inbound.get('settings') or {}).get('clients') or []:
+                if old_clients.get((tag, client.get('email') or '')) != client:
+                    entry = added.setdefault(tag, {
+                        'tag': tag,
+                        'protocol': inbound.get('protocol'),
+                        'settings': {'clients': [], 'decryption': 'none'},
+                    })
+                    entry['settings']['clients'].append(client)
+        return ServiceChange(service, api, list(added.values()), removed, False)
+
+    def deploy_configs(self) -> List[ServiceChange]:
         print("\n=== Deploying Configurations ===\n")
+
+        if self.config.get('xray_transport', 'tcp') == 'unix':
+            self.prepare_socket_dir()
         
-        caddy_path = "/etc/caddy/Caddyfile"
-        if os.path.exists("Caddyfile"):
+        store = self.artifacts()
+        changes: List[ServiceChange] = []
+        for source, target, service, api in self.deploy_targets():
+            if not os.path.exists(source):
+                continue
+            # Read what is running now, so client-only edits can go over the API
+            previous = self.read_json(target) if api else None
+            # Caddy may still reject the file on reload; keep the old one to put back
+            backup = None if api else f"{target}.previous"
             try:
-                subprocess.run(f"cp Caddyfile {caddy_path}", shell=True, check=True)
-                print(f"✓ Caddyfile deployed to {caddy_path}")
-            except subprocess.CalledProcessError:
-                print(f"Warning: Failed to copy Caddyfile. You may need to manually copy it to {caddy_path}")
+                if store.deploy(source, target, backup):
+                    current = self.read_json(source) if api else None
+                    changes.append(self.plan_change(service, api, previous, current))
+                    print(f"✓ {source} deployed to {target}")
+                else:
+                    print(f"✓ {target} already up to date")
+            except OSError as e:
+                print(f"Warning: Failed to copy {source} ({e}). You may need to manually copy it to {target}")
+        store.save()
         
-        xray_path = "/usr/local/etc/xray/config.json"
-        if os.path.exists("xray_config.json"):
+        print("\n✓ Configuration deployment completed")
+        return changes
+
+    def reload_caddy(self, caddyfile: str = "Caddyfile") -> bool:
+        # POST the Caddyfile to the admin API: Caddy swaps configs in place
+        # and, with stream_close_delay, leaves open tunnels alone. Returns
+        # False only when the API is unreachable and a restart is needed;
+        # a rejected config is reported and the running one kept.
+        admin = self.config.get('caddy_admin', 'http://localhost:2019').rstrip('/')
+        try:
+            with open(caddyfile, 'rb') as f:
+                response = requests.post(f"{admin}/load", data=f.read(),
+                                         headers={'Content-Type': 'text/caddyfile'}, timeout=30)
+        except (OSError, requests.RequestException) as e:
+            print(f"Warning: Caddy admin API at {admin} unreachable ({e})")
+            return False
+        if response.status_code != 200:
+            print(f"Error: Caddy rejected the new config, keeping the running one: {response.text.strip()}")
+            self.revert_deploy(caddyfile, CADDYFILE_PATH)
+        else:
+            print("✓ caddy reloaded via admin API")
+        return True
+
+    def revert_deploy(self, source: str, target: str):
+        # Without this the rejected file would stay installed and marked
+        # deployed, and the next run would report it up to date
+        store = self.artifacts()
+        try:
+            store.revert(source, target, f"{target}.previous")
+        except OSError as e:
+            print(f"Warning: Failed to restore the previous {target} ({e})")
+            return
+        store.save()
+        print(f"✓ Previous {target} restored, {source} will be deployed again on the next run")
+
+    def xray_api(self, api: str, command: str, *args: str) -> bool:
+        # "xray_bin" may carry arguments, e.g. a stand-in such as
+        # "python3 mock_admin.py xray"
+        argv = shlex.split(self.config.get('xray_bin', 'xray')) + ['api', command, f'--server={api}', *args]
+        try:
+            subprocess.run(argv, check=True, capture_output=True, text=True, timeout=30)
+        except (OSError, subprocess.SubprocessError) as e:
+            detail = getattr(e, 'stderr', None) or e
+            print(f"Warning: xray api {command} against {api} failed: {str(detail).strip()}")
+            return False
+        return True
+
+    def apply_xray_change(self, change: ServiceChange) -> bool:
+        by_tag: Dict[str, List[str]] = {}
+        for tag, email in change.remove_users:
+            by_tag.setdefault(tag, []).append(email)
+        for tag, emails in by_tag.items():
+            if not self.xray_api(change.api, 'rmu', f'-tag={tag}', *emails):
+                return False
+
+        if change.add_inbounds:
+            with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+                json.dump({'inbounds': change.add_inbounds}, f)
+            try:
+                return self.xray_api(change.api, 'adu', f.name)
+            finally:
+                os.unlink(f.name)
+        return True
+
+    @staticmethod
+    def systemctl_check(command: str) -> bool:
+        return subprocess.run(f"systemctl {command}", shell=True,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+    def xray_units(self) -> List[str]:
+        # xray@gfwmass-* instances systemd knows about, from any worker count
+        try:
+            result = subprocess.run("systemctl list-units --all --plain --no-legend 'xray@gfwmass-*'",
+                                    shell=True, check=True, capture_output=True, text=True)
+        except subprocess.CalledProcessError:
+            return []
+        units = [line.split()[0] for line in result.stdout.splitlines() if line.strip()]
+        return [unit[:-len('.service')] if unit.endswith('.service') else unit for unit in units]
+
+    def scale_xray_units(self):
+        # Match the running units to "workers": instances past the count
+        # would keep serving stale configs on their old ports, and the stock
+        # unit is only wanted (and may have been disabled) for one worker
+        wanted = {instance['service'] for instance in self.xray_instances()}
+        for unit in self.xray_units():
+            if unit in wanted:
+                continue
             try:
-                subprocess.run(f"cp xray_config.json {xray_path}", shell=True, check=True)
-                print(f"✓ Xray config deployed to {xray_path}")
+                subprocess.run(f"systemctl disable --now {unit}", shell=True, check=True)
+                print(f"✓ {unit} stopped, it is beyond the configured workers")
             except subprocess.CalledProcessError:
-                print(f"Warning: Failed to copy Xray config. You may need to manually copy it to {xray_path}")
-        
-        print("\n✓ Configuration deployment completed")
+                print(f"Warning: Failed to stop {unit}. You may need to disable it manually.")
+
+        if 'xray' in wanted:
+            if self.systemctl_check("is-enabled --quiet xray"):
+                return
+            try:
+                subprocess.run("systemctl enable --now xray", shell=True, check=True)
+                print("✓ xray re-enabled for a single worker")
+            except subprocess.CalledProcessError:
+                print("Warning: Failed to enable xray. You may need to do this manually.")
+        elif self.systemctl_check("is-enabled --quiet xray") or self.systemctl_check("is-active --quiet xray"):
+            # The stock unit would still bind xray_port from config.json
+            try:
+                subprocess.run("systemctl disable --now xray", shell=True, check=True)
+                print("✓ xray stopped in favour of per-worker xray@ instances")
+            except subprocess.CalledProcessError:
+                print("Warning: Failed to stop xray. It may conflict with the worker instances.")
+
+    def reload_services(self, changes: List[ServiceChange]):
+        print("\n=== Reloading Services ===\n")
+        self.scale_xray_units()
+        if not changes:
+            print("✓ No configuration changed, services left running")
+            return
+
+        restart: List[str] = []
+        for change in changes:
+            if change.service == 'caddy':
+                if not self.reload_caddy():
+                    restart.append(change.service)
+            elif change.restart:
+                print(f"{change.service}: inbound topology changed (or first deploy), restart required")
+                restart.append(change.service)
+            elif self.apply_xray_change(change):
+                added = sum(len(inbound['settings']['clients']) for inbound in change.add_inbounds)
+                print(f"✓ {change.service}: {added} clients added, {len(change.remove_users)} removed without restart")
+            else:
+                restart.append(change.service)
+
+        if restart:
+            self.restart_services(restart)
     
-    def restart_services(self):
+    def restart_services(self, services: Optional[List[str]] = None):
         print("\n=== Restarting Services ===\n")
         
-        services = ["caddy", "xray"]
+        if services is None:
+            # reload_services has already done this for a partial restart
+            self.scale_xray_units()
+            services = ["caddy"] + [instance['service'] for instance in self.xray_instances()]
+
         for service in services:
             try:
+                if service.startswith('xray@'):
+                    subprocess.run(f"systemctl enable {service}", shell=True, check=True)
                 subprocess.run(f"systemctl restart {service}", shell=True, check=True)
                 print(f"✓ {service} restarted")
             except subprocess.CalledProcessError:
@@ -375,11 +3029,63 @@ class GFWMass:
         
         print("\n✓ Services restart completed")
 
+    def deploy(self, sync: bool = False, resume: bool = True, reinstall: bool = False) -> List[StageResult]:
+        # DNS provisioning only talks to Cloudflare, so it overlaps the
+        # local install/deploy/restart chain instead of running before it
+        def provision_dns():
+            if sync:
+                print("\n=== Reconciling Cloudflare DNS ===\n")
+                return self.sync_cloudflare_records()
+            print("\n=== Deploying to Cloudflare ===\n")
+            return self.add_cloudflare_records(resume=resume)
+
+        graph = TaskGraph()
+        graph.add('dns', provision_dns)
+        graph.add('install', lambda: self.install_dependencies(force=reinstall))
+        changed: Dict[str, List[ServiceChange]] = {}
+        graph.add('deploy', lambda: changed.setdefault('services', self.deploy_configs()), after=['install'])
+        if reinstall:
+            # New binaries only take effect after a restart
+            graph.add('restart', self.restart_services, after=['deploy'])
+        else:
+            graph.add('reload', lambda: self.reload_services(changed['services']), after=['deploy'])
+
+        started = time.perf_counter()
+        results = graph.run()
+        for stage in results:
+            self.metrics.record_phase(stage.name, stage.seconds)
+        self.print_stage_timings(results, time.perf_counter() - started)
+        return results
+
+    @staticmethod
+    def print_stage_timings(results: List[StageResult], wall: float):
+        print("\n=== Deploy Timing ===\n")
+        for stage in results:
+            note = f"  ({stage.error})" if stage.error else ""
+            print(f"  {stage.name:<10} {stage.seconds:8.2f}s  {stage.status}{note}")
+        serial = sum(stage.seconds for stage in results)
+        print(f"  {'total':<10} {wall:8.2f}s  (sequential: {serial:.2f}s)")
+
+    def export_metrics(self, json_path: Optional[str] = None, prometheus_path: Optional[str] = None):
+        # "metrics": {"json_file": ..., "prometheus_file": ...} set defaults
+        # for unattended runs; flags override them
+        options = self.config.get('metrics', {})
+        json_path = json_path or options.get('json_file')
+        prometheus_path = prometheus_path or options.get('prometheus_file')
+        if not self.metrics.phases and not self.metrics.calls:
+            return
+        if json_path:
+            self.metrics.write_json(json_path)
+            print(f"✓ Metrics written to {json_path}")
+        if prometheus_path:
+            self.metrics.write_prometheus(prometheus_path)
+            print(f"✓ Prometheus metrics written to {prometheus_path}")
+
     def write_manual_dns_instructions(self):
-        base_domain = self.config['domain']
+        zones = self.zones()
+        base_domain = zones[0].domain
         email = self.config.get('email', 'admin@example.com')
-        cert_path = self.config.get('manual_cert_path', '/etc/ssl/gfwmass/fullchain.pem')
-        key_path = self.config.get('manual_key_path', '/etc/ssl/gfwmass/privkey.pem')
+        cert_path, key_path = self.zone_cert_paths(zones[0])
 
         instructions = f"""
 Manual DNS-01 Certificate (Wildcard) Instructions
@@ -414,10 +3120,14 @@ Issue wildcard via certbot (manual DNS-01):
 
 Renewals: Manual DNS renewals require repeating the challenge. Consider automating via certbot DNS plugins for your provider.
 """
+        if len(zones) > 1:
+            instructions += "\nAdditional zones: repeat steps 2-4 for each, copying the files to:\n"
+            for zone in zones[1:]:
+                zone_cert, zone_key = self.zone_cert_paths(zone)
+                instructions += f"- {zone.domain} (*.{zone.domain}): {zone_cert} and {zone_key}\n"
 
-        with open('MANUAL_DNS.md', 'w') as f:
+        with self.artifacts().open('MANUAL_DNS.md') as f:
             f.write(instructions)
-        print("✓ MANUAL_DNS.md generated (manual DNS-01 guidance)")
 
 
 def main():
@@ -435,70 +3145,211 @@ Examples:
   # Install dependencies only
   python3 gfwmass.py --install-only
 
+  # Serve domains.txt as a subscription with 50-domain per-client shards
+  # (set "subscription_server": {"shard_size": 50} in config.json)
+  python3 gfwmass.py --serve-subscription --listen 0.0.0.0:8080
+
+  # Keep rotating the deployed set (see "rotation" in README), serving
+  # the subscription from the same process
+  python3 gfwmass.py --daemon --listen 0.0.0.0:8080
+
+  # Preview, then apply, the DNS changes needed to reach 500 domains
+  python3 gfwmass.py --sync --count 500 --dry-run
+  python3 gfwmass.py --sync --count 500
+
 Commands:
   generate-only: Generate configs without deploying to Cloudflare
   deploy: Deploy DNS records to Cloudflare and install services
   install-only: Install dependencies without generating configs
+  sync: Reconcile Cloudflare with domains.txt (topped up/trimmed to --count)
+  daemon: Retire and replace domains on a schedule within an API budget
         """
     )
     
     parser.add_argument('-c', '--config', default='config.json',
                        help='Configuration file path (default: config.json)')
-    parser.add_argument('-n', '--count', type=int, default=100,
-                       help='Number of subdomains to generate (default: 100)')
+    parser.add_argument('-n', '--count', type=int, default=None,
+                       help='Number of subdomains to generate (default: 100; with --sync: size of domains.txt)')
     parser.add_argument('--generate-only', action='store_true',
                        help='Generate configs only without Cloudflare deployment')
     parser.add_argument('--deploy', action='store_true',
                        help='Deploy to Cloudflare and install services')
     parser.add_argument('--install-only', action='store_true',
                        help='Install dependencies only')
+    parser.add_argument('--add-user', metavar='EMAIL',
+                       help='Register a user in the state database and render only their subscription '
+                            '(with --deploy: push the client to running Xray without a restart)')
+    parser.add_argument('--user-uuid', metavar='UUID',
+                       help='With --add-user: UUID to use (default: generated)')
+    parser.add_argument('--remove-user', metavar='EMAIL',
+                       help='Remove a user added with --add-user (with --deploy: drop the client live)')
+    parser.add_argument('--metrics', metavar='FILE',
+                       help='Write per-phase timings and Cloudflare API metrics as JSON to FILE')
+    parser.add_argument('--metrics-prom', metavar='FILE',
+                       help='Write the same metrics as a Prometheus textfile-collector file (*.prom)')
+    parser.add_argument('--profile', metavar='DIR',
+                       help='Dump cProfile stats for subdomain generation and config rendering into DIR')
+    parser.add_argument('--reinstall', action='store_true',
+                       help='With --deploy/--install-only: reinstall Caddy, certbot and Xray even if already present')
     parser.add_argument('--remove-dns', action='store_true',
                        help='Remove Cloudflare A records for generated domains (uses domains.txt if present)')
+    parser.add_argument('--remove-pattern', metavar='GLOB',
+                       help='With --remove-dns: remove A records whose name matches GLOB (e.g. "cdn-*.example.com")')
+    parser.add_argument('--remove-origin', metavar='IP',
+                       help='With --remove-dns: remove A records pointing at IP')
+    parser.add_argument('--serve-subscription', action='store_true',
+                       help='Serve the subscription for domains.txt over HTTP (ETag/gzip, optional per-client shards)')
+    parser.add_argument('--daemon', action='store_true',
+                       help='Run persistently, replacing the oldest/unhealthy domains every rotation.interval seconds')
+    parser.add_argument('--cycles', type=int, default=None,
+                       help='With --daemon: exit after this many rotations (default: run until stopped)')
+    parser.add_argument('--listen', metavar='HOST:PORT',
+                       help='With --serve-subscription or --daemon: serve the subscription on this address '
+                            '(default for --serve-subscription: subscription_server in config, 127.0.0.1:8080)')
+    parser.add_argument('--no-resume', action='store_true',
+                       help='With --deploy: abandon an interrupted deploy instead of resuming it')
+    parser.add_argument('--status', action='store_true',
+                       help='Show provisioning status from the local state database')
+    parser.add_argument('--probe', action='store_true',
+                       help='Probe every domain in domains.txt (DNS, TLS, WebSocket) and record latency percentiles')
+    parser.add_argument('--seed', type=int, default=None,
+                       help='Seed for reproducible subdomain generation')
+    parser.add_argument('--sync', action='store_true',
+                       help='Apply only the DNS changes needed to match domains.txt (combine with --deploy to also install)')
+    parser.add_argument('--dry-run', action='store_true',
+                       help='With --sync: print the planned DNS changes without applying them')
     
     args = parser.parse_args()
+    count = args.count if args.count is not None else 100
+
+    def load() -> GFWMass:
+        gfw = GFWMass(args.config)
+        if args.seed is not None:
+            gfw.seed = args.seed
+        gfw.metrics.profile_dir = args.profile
+        try:
+            gfw.tuning_profile()
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        # Exported however the run ends, so a failed deploy still reports
+        atexit.register(gfw.export_metrics, args.metrics, args.metrics_prom)
+        return gfw
     
+    if args.serve_subscription:
+        gfw = load()
+        gfw.serve_subscription(args.listen)
+        return
+
+    if args.daemon:
+        gfw = load()
+        gfw.run_daemon(args.cycles, args.listen)
+        return
+
+    if args.status:
+        gfw = load()
+        gfw.print_status()
+        return
+
+    if args.probe:
+        gfw = load()
+        gfw.domains = gfw.load_domains()
+        with gfw.metrics.phase('probe'):
+            gfw.probe_domains()
+        probe = gfw.config.get('probe', {})
+        if probe.get('sort_subscription') or probe.get('max_latency_ms'):
+            # Per-user and per-origin files are ranked the same way
+            count = gfw.write_subscriptions()
+            gfw.artifacts().save()
+            print(f"✓ Subscriptions rewritten with {count} endpoints ordered by latency")
+        return
+
     if args.install_only:
-        gfw = GFWMass(args.config)
-        gfw.install_dependencies()
+        gfw = load()
+        with gfw.metrics.phase('install'):
+            gfw.install_dependencies(force=args.reinstall)
         return
 
     if args.remove_dns:
-        gfw = GFWMass(args.config)
+        gfw = load()
+        if args.remove_pattern or args.remove_origin:
+            with gfw.metrics.phase('dns'):
+                gfw.remove_cloudflare_records(pattern=args.remove_pattern, origin_ip=args.remove_origin)
+            return
         # Prefer existing domains.txt; fall back to generating a new set
         if os.path.exists('domains.txt'):
-            with open('domains.txt', 'r') as f:
-                domains = [line.strip() for line in f if line.strip()]
+            domains = gfw.load_domains()
         else:
-            domains = gfw.generate_subdomains(args.count)
-        gfw.remove_cloudflare_records(domains)
+            with gfw.metrics.phase('generate', profile=True):
+                domains = gfw.generate_subdomains(count)
+        with gfw.metrics.phase('dns'):
+            gfw.remove_cloudflare_records(domains)
         return
     
+    if args.add_user or args.remove_user:
+        gfw = load()
+        gfw.domains = gfw.load_domains()
+        if args.add_user:
+            try:
+                user = gfw.add_user(args.add_user, args.user_uuid)
+            except ValueError as e:
+                print(f"Error: {e}")
+                return
+            print(f"✓ {user.email}: {user.id}")
+        elif not gfw.remove_user(args.remove_user):
+            print(f"Error: no user {args.remove_user} in the state database")
+            return
+        with gfw.metrics.phase('save'):
+            gfw.save_configs()
+        if args.add_user:
+            print(f"✓ Subscription: {gfw.user_subscription_path(user)}")
+        if args.deploy:
+            with gfw.metrics.phase('deploy'):
+                gfw.reload_services(gfw.deploy_configs())
+        return
+
     # Initialize
-    gfw = GFWMass(args.config)
-    
-    # Generate subdomains
-    print(f"\n=== Generating {args.count} Subdomains ===\n")
-    domains = gfw.generate_subdomains(args.count)
-    print(f"✓ Generated {len(domains)} subdomains")
-    print(f"Examples: {domains[:5]}")
+    gfw = load()
+
+    resume = False
+    if args.sync:
+        with gfw.metrics.phase('generate', profile=True):
+            domains = gfw.desired_domains(args.count)
+        print(f"\n=== Syncing {len(domains)} Domains with Cloudflare ===\n")
+        if args.dry_run:
+            with gfw.metrics.phase('dns'):
+                gfw.sync_cloudflare_records(dry_run=True)
+            return
+    elif args.deploy and not args.no_resume and gfw.resume_deploy():
+        resume = True
+        domains = gfw.domains
+        print(f"\n=== Resuming Interrupted Deploy of {len(domains)} Subdomains ===\n")
+        print("(run with --no-resume to abandon it and generate a new set)")
+    else:
+        if args.deploy and args.no_resume:
+            gfw.abandon_deploy()
+        # Generate subdomains
+        print(f"\n=== Generating {count} Subdomains ===\n")
+        with gfw.metrics.phase('generate', profile=True):
+            domains = gfw.generate_subdomains(count)
+        print(f"✓ Generated {len(domains)} subdomains")
+        print(f"Examples: {domains[:5]}")
     
     # Save configurations
     print("\n=== Generating Configurations ===\n")
-    gfw.save_configs()
+    with gfw.metrics.phase('save', profile=True):
+        gfw.save_configs()
+
+    if args.sync and not args.deploy:
+        print("\n=== Reconciling Cloudflare DNS ===\n")
+        with gfw.metrics.phase('dns'):
+            gfw.sync_cloudflare_records()
     
     if args.deploy:
-        # Add to Cloudflare
-        print("\n=== Deploying to Cloudflare ===\n")
-        gfw.add_cloudflare_records()
-
-        print("\n=== Installing Dependencies ===")
-        gfw.install_dependencies()
-        
-        print("\n=== Deploying Configurations ===")
-        gfw.deploy_configs()
-        
-        print("\n=== Restarting Services ===")
-        gfw.restart_services()
+        stages = gfw.deploy(sync=args.sync, resume=resume, reinstall=args.reinstall)
+        failed = [stage.name for stage in stages if stage.status != 'ok']
+        if failed:
+            print(f"\nWarning: stages did not complete cleanly: {', '.join(failed)}")
         
         print("\n" + "="*50)
         print("✓ Deployment flow completed (check manual DNS instructions if applicable)")
@@ -509,7 +3360,7 @@ Commands:
         print("3. Configure client to rotate endpoints every few minutes")
         print("4. Monitor logs: journalctl -u caddy -f")
         print("            journalctl -u xray -f")
-    else:
+    elif not args.sync:
         print("\n" + "="*50)
         print("✓ Configuration generation completed!")
         print("="*50)
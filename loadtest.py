@@ -0,0 +1,732 @@
+#!/usr/bin/env python3
+
+# End-to-end load test of the Caddy -> Xray chain on loopback. The configs
+# come from gfwmass.py (Caddyfile, xray_config*.json, subscription links) and
+# run behind a self-signed wildcard certificate; clients open VLESS over
+# WebSocket connections with asyncio, exactly as the subscription describes
+# them, and tunnel to a local echo server.
+#
+#   python3 loadtest.py --connections 2000 --bytes 262144
+#   python3 loadtest.py --set workers=2 --set xray_transport='"unix"' -o unix.json
+#   python3 loadtest.py --tuning-profile all -o profiles.json
+#
+# The real caddy and xray binaries are used when both are on PATH (or with
+# --backend real); otherwise asyncio stand-ins read the generated configs:
+# a TLS-terminating TCP relay for Caddy and a VLESS/WebSocket server with a
+# direct (freedom) outbound for Xray. Stand-in numbers compare configs
+# against each other, not against the real servers.
+
+import asyncio
+import base64
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import resource
+import shutil
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import List, Dict, Any, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+import argparse
+
+from gfwmass import GFWMass, PROFILES, percentile
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC11B65"
+
+# Opcodes used here: binary data, close
+WS_BINARY = 0x2
+WS_CLOSE = 0x8
+
+CHUNK = 16384
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        with contextlib.suppress(ValueError, OSError):
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def apply_mask(data: bytes, key: bytes) -> bytes:
+    if not data:
+        return data
+    size = len(data)
+    mask = (key * (size // 4 + 1))[:size]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(mask, 'big')).to_bytes(size, 'big')
+
+
+def ws_frame(payload: bytes, opcode: int = WS_BINARY, mask: bool = False) -> bytes:
+    # Clients must mask what they send; servers must not
+    header = bytearray([0x80 | opcode])
+    bit = 0x80 if mask else 0
+    size = len(payload)
+    if size < 126:
+        header.append(bit | size)
+    elif size < 1 << 16:
+        header.append(bit | 126)
+        header += struct.pack('!H', size)
+    else:
+        header.append(bit | 127)
+        header += struct.pack('!Q', size)
+    if mask:
+        key = os.urandom(4)
+        header += key
+        payload = apply_mask(payload, key)
+    return bytes(header) + payload
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[int, bytes]:
+    head = await reader.readexactly(2)
+    opcode = head[0] & 0x0f
+    size = head[1] & 0x7f
+    if size == 126:
+        size = struct.unpack('!H', await reader.readexactly(2))[0]
+    elif size == 127:
+        size = struct.unpack('!Q', await reader.readexactly(8))[0]
+    key = await reader.readexactly(4) if head[1] & 0x80 else None
+    payload = await reader.readexactly(size)
+    return opcode, apply_mask(payload, key) if key else payload
+
+
+class FrameStream:
+
+    # Payload bytes across frame boundaries: the proxy chain is free to
+    # split or merge what the echo server sends back
+    def __init__(self, reader: asyncio.StreamReader):
+        self.reader = reader
+        self.buffer = bytearray()
+
+    async def _fill(self):
+        opcode, payload = await read_frame(self.reader)
+        if opcode == WS_CLOSE:
+            raise ConnectionError("WebSocket closed by server")
+        self.buffer += payload
+
+    async def read(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            await self._fill()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    async def skip(self, size: int):
+        while size > 0:
+            if not self.buffer:
+                await self._fill()
+            taken = min(size, len(self.buffer))
+            del self.buffer[:taken]
+            size -= taken
+
+
+def vless_request(user_id: str, host: str, port: int) -> bytes:
+    # version 0, UUID, no addons, command 1 (TCP), port, address type 1 (IPv4)
+    return (b'\x00' + uuid.UUID(user_id).bytes + b'\x00\x01' + struct.pack('!H', port) +
+            b'\x01' + socket.inet_aton(host))
+
+
+class Link(NamedTuple):
+    user_id: str
+    server_name: str
+    host: str
+    path: str
+
+
+def parse_link(link: str) -> Link:
+    url = urlparse(link)
+    query = {key: values[0] for key, values in parse_qs(url.query).items()}
+    return Link(url.username, query.get('sni', url.hostname), query.get('host', url.hostname),
+                query.get('path', '/ws'))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_cpu(pid: int) -> Optional[float]:
+    # utime + stime in seconds (Linux); None where /proc is unavailable
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+# -- Stand-ins ---------------------------------------------------------------
+
+async def close_writer(writer: asyncio.StreamWriter):
+    writer.close()
+    with contextlib.suppress(Exception):
+        await writer.wait_closed()
+
+
+async def relay(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    with contextlib.suppress(ConnectionError, OSError):
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+
+
+async def splice(a: Tuple[asyncio.StreamReader, asyncio.StreamWriter],
+                 b: Tuple[asyncio.StreamReader, asyncio.StreamWriter]):
+    # Both directions until either side finishes, then tear down both
+    tasks = [asyncio.ensure_future(relay(a[0], b[1])), asyncio.ensure_future(relay(b[0], a[1]))]
+    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in tasks:
+        task.cancel()
+    await close_writer(a[1])
+    await close_writer(b[1])
+
+
+async def open_upstream(upstream: str):
+    # Caddy's upstream syntax: "unix//path/to.sock" or "host:port"
+    if upstream.startswith('unix/'):
+        return await asyncio.open_unix_connection(upstream[len('unix/'):])
+    host, _, port = upstream.rpartition(':')
+    return await asyncio.open_connection(host, int(port))
+
+
+async def serve_caddy(port: int, cert: str, key: str, upstreams: List[str]):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    turn = [0]
+
+    async def handle(reader, writer):
+        upstream = upstreams[turn[0] % len(upstreams)]
+        turn[0] += 1
+        try:
+            pair = await open_upstream(upstream)
+        except OSError:
+            await close_writer(writer)
+            return
+        await splice((reader, writer), pair)
+
+    server = await asyncio.start_server(handle, '127.0.0.1', port, ssl=context, backlog=4096)
+    async with server:
+        await server.serve_forever()
+
+
+async def serve_xray(config_path: str):
+    with open(config_path) as f:
+        config = json.load(f)
+    inbound = next(inbound for inbound in config['inbounds'] if inbound.get('protocol') == 'vless')
+    ids = {uuid.UUID(client['id']).bytes for client in inbound['settings']['clients']}
+    path = inbound.get('streamSettings', {}).get('wsSettings', {}).get('path', '/')
+    # Policy bufferSize (KiB) is how far Xray reads ahead of a slow peer;
+    # here it becomes the write-buffer high-water mark. 512 is Xray's default
+    level = config.get('policy', {}).get('levels', {}).get('0', {})
+    buffer = level.get('bufferSize', 512) * 1024
+
+    async def handle(reader, writer):
+        upstream = None
+        try:
+            request = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+            target = request[0].split(' ')[1] if len(request[0].split(' ')) > 1 else ''
+            headers = {name.strip().lower(): value.strip()
+                       for name, _, value in (line.partition(':') for line in request[1:] if line)}
+            if target.split('?')[0] != path or 'sec-websocket-key' not in headers:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+                return
+            accept = base64.b64encode(hashlib.sha1((headers['sec-websocket-key'] + WS_GUID).encode()).digest())
+            writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+                         b"Connection: Upgrade\r\nSec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+
+            _, first = await read_frame(reader)
+            if first[1:17] not in ids:
+                return
+            offset = 18 + first[17]
+            port = struct.unpack('!H', first[offset + 1:offset + 3])[0]
+            if first[offset + 3] != 1:
+                return
+            host = socket.inet_ntoa(first[offset + 4:offset + 8])
+            upstream = await asyncio.open_connection(host, port)
+            writer.transport.set_write_buffer_limits(high=buffer)
+            upstream[1].transport.set_write_buffer_limits(high=buffer)
+            upstream[1].write(first[offset + 8:])
+
+            async def uplink():
+                while True:
+                    opcode, data = await read_frame(reader)
+                    if opcode == WS_CLOSE:
+                        return
+                    upstream[1].write(data)
+                    await upstream[1].drain()
+
+            async def downlink():
+                prefix = b'\x00\x00'  # VLESS response: version, no addons
+                while True:
+                    data = await upstream[0].read(65536)
+                    if not data:
+                        return
+                    writer.write(ws_frame(prefix + data))
+                    prefix = b''
+                    await writer.drain()
+
+            tasks = [asyncio.ensure_future(uplink()), asyncio.ensure_future(downlink())]
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                task.cancel()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, OSError, IndexError):
+            pass
+        finally:
+            if upstream:
+                await close_writer(upstream[1])
+            await close_writer(writer)
+
+    listen = inbound.get('listen', '')
+    if listen.startswith('/'):
+        socket_path, _, mode = listen.partition(',')
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)
+        server = await asyncio.start_unix_server(handle, socket_path, backlog=4096)
+        os.chmod(socket_path, int(mode or '0666', 8))
+    else:
+        server = await asyncio.start_server(handle, '127.0.0.1', inbound['port'], backlog=4096)
+    async with server:
+        await server.serve_forever()
+
+
+async def serve_echo(port: int):
+    async def handle(reader, writer):
+        await relay(reader, writer)
+        await close_writer(writer)
+
+    server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=4096)
+    async with server:
+        await server.serve_forever()
+
+
+def standin_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='loadtest.py standin')
+    parser.add_argument('kind', choices=['caddy', 'xray', 'echo'])
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--cert')
+    parser.add_argument('--key')
+    parser.add_argument('--upstream', action='append', default=[])
+    parser.add_argument('--config')
+    args = parser.parse_args(argv)
+    raise_fd_limit()
+    with contextlib.suppress(KeyboardInterrupt):
+        if args.kind == 'caddy':
+            asyncio.run(serve_caddy(args.port, args.cert, args.key, args.upstream))
+        elif args.kind == 'xray':
+            asyncio.run(serve_xray(args.config))
+        else:
+            asyncio.run(serve_echo(args.port))
+
+
+# -- Harness -----------------------------------------------------------------
+
+class Service(NamedTuple):
+    name: str
+    process: subprocess.Popen
+
+
+def make_certificate(workdir: str, domains: List[str]) -> Tuple[str, str]:
+    if shutil.which('openssl') is None:
+        raise RuntimeError("openssl not found; it is needed for the self-signed wildcard certificate")
+    cert = os.path.join(workdir, 'fullchain.pem')
+    key = os.path.join(workdir, 'privkey.pem')
+    names = ','.join(f"DNS:{name}" for domain in domains for name in (domain, f"*.{domain}"))
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+         '-nodes', '-days', '1', '-subj', f"/CN=*.{domains[0]}", '-addext', f"subjectAltName={names}",
+         '-keyout', key, '-out', cert],
+        check=True, capture_output=True)
+    return cert, key
+
+
+def loopback_caddyfile(caddyfile: str, https_port: int) -> str:
+    # The generated Caddyfile as deployed, moved off the privileged ports
+    # and without an admin endpoint that could clash with a local Caddy
+    overrides = (f"    admin off\n    https_port {https_port}\n    http_port {free_port()}\n"
+                 "    auto_https disable_redirects\n")
+    return caddyfile.replace("{\n", "{\n" + overrides, 1)
+
+
+def wait_ready(address: Any, process: subprocess.Popen, timeout: float = 15.0):
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args[0]} exited with {process.returncode} during startup")
+        with socket.socket(family, socket.SOCK_STREAM) as s:
+            try:
+                s.connect(address)
+                return
+            except OSError:
+                time.sleep(0.05)
+    raise RuntimeError(f"{address} not accepting connections after {timeout:g}s")
+
+
+def start_services(gfw: GFWMass, workdir: str, backend: str, caddy_port: int,
+                   echo_port: int, cert: str, key: str) -> List[Service]:
+    here = os.path.abspath(__file__)
+    log = open(os.path.join(workdir, 'services.log'), 'w')
+    services: List[Service] = []
+
+    def spawn(name: str, argv: List[str], address: Any):
+        process = subprocess.Popen(argv, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+        services.append(Service(name, process))
+        wait_ready(address, process)
+
+    try:
+        spawn('echo', [sys.executable, here, 'standin', 'echo', '--port', str(echo_port)],
+              ('127.0.0.1', echo_port))
+        instances = gfw.xray_instances()
+        for instance in instances:
+            address = instance['socket'] or ('127.0.0.1', instance['port'])
+            config = os.path.join(workdir, instance['file'])
+            if backend == 'real':
+                argv = ['xray', 'run', '-c', config]
+            else:
+                argv = [sys.executable, here, 'standin', 'xray', '--config', config]
+            spawn(f"xray-{instance['index']}" if len(instances) > 1 else 'xray', argv, address)
+
+        if backend == 'real':
+            path = os.path.join(workdir, 'Caddyfile.loadtest')
+            with open(os.path.join(workdir, 'Caddyfile')) as f:
+                caddyfile = loopback_caddyfile(f.read(), caddy_port)
+            with open(path, 'w') as f:
+                f.write(caddyfile)
+            argv = ['caddy', 'run', '--config', path, '--adapter', 'caddyfile']
+        else:
+            argv = [sys.executable, here, 'standin', 'caddy', '--port', str(caddy_port),
+                    '--cert', cert, '--key', key]
+            for instance in instances:
+                upstream = instance['upstream'].replace('localhost:', '127.0.0.1:')
+                argv += ['--upstream', upstream]
+        spawn('caddy', argv, ('127.0.0.1', caddy_port))
+    except Exception:
+        stop_services(services)
+        raise
+    return services
+
+
+def stop_services(services: List[Service]):
+    for service in services:
+        service.process.terminate()
+    for service in services:
+        try:
+            service.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            service.process.kill()
+
+
+class Stats:
+
+    def __init__(self):
+        self.setup_ms: List[float] = []
+        self.rtt_ms: List[float] = []
+        self.errors: Dict[str, int] = {}
+        self.bytes = 0
+        self.open = 0
+        self.peak_open = 0
+        self.first_setup: Optional[float] = None
+        self.last_setup: Optional[float] = None
+        self.bulk_started: Optional[float] = None
+        self.bulk_finished: Optional[float] = None
+
+    def error(self, e: BaseException):
+        name = type(e).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+
+async def drive(link: Link, options: Dict[str, Any], context: ssl.SSLContext, stats: Stats):
+    timeout = options['timeout']
+    started = time.perf_counter()
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection('127.0.0.1', options['caddy_port'], ssl=context,
+                                    server_hostname=link.server_name), timeout)
+        stats.open += 1
+        stats.peak_open = max(stats.peak_open, stats.open)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((f"GET {link.path} HTTP/1.1\r\nHost: {link.host}\r\nUpgrade: websocket\r\n"
+                      f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n"
+                      f"Sec-WebSocket-Version: 13\r\n\r\n").encode())
+        response = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+        status = response.split(b'\r\n', 1)[0]
+        if status.split()[1:2] != [b'101']:
+            raise ConnectionError(f"upgrade refused: {status.decode(errors='replace')}")
+
+        # Header plus a first payload: Xray only answers once the target does
+        stream = FrameStream(reader)
+        hello = os.urandom(32)
+        writer.write(ws_frame(vless_request(link.user_id, '127.0.0.1', options['echo_port']) + hello,
+                              mask=True))
+        _, addons = await asyncio.wait_for(stream.read(2), timeout)
+        await stream.skip(addons)
+        if await asyncio.wait_for(stream.read(len(hello)), timeout) != hello:
+            raise ConnectionError("echo mismatch")
+        finished = time.perf_counter()
+        stats.setup_ms.append((finished - started) * 1000)
+        stats.first_setup = min(stats.first_setup or finished, finished)
+        stats.last_setup = max(stats.last_setup or finished, finished)
+
+        ping = b'\0' * options['ping_size']
+        for _ in range(options['pings']):
+            sent = time.perf_counter()
+            writer.write(ws_frame(ping, mask=True))
+            await asyncio.wait_for(stream.skip(len(ping)), timeout)
+            stats.rtt_ms.append((time.perf_counter() - sent) * 1000)
+
+        total = options['bytes']
+        if total:
+            async def send():
+                chunk = os.urandom(CHUNK)
+                remaining = total
+                while remaining > 0:
+                    writer.write(ws_frame(chunk[:remaining], mask=True))
+                    remaining -= CHUNK
+                    await writer.drain()
+
+            began = time.perf_counter()
+            stats.bulk_started = min(stats.bulk_started or began, began)
+            sender = asyncio.ensure_future(send())
+            await asyncio.wait_for(stream.skip(total), max(timeout, total / (1 << 20) * timeout))
+            await sender
+            stats.bytes += total
+            ended = time.perf_counter()
+            stats.bulk_finished = max(stats.bulk_finished or ended, ended)
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, OSError, ssl.SSLError) as e:
+        stats.error(e)
+    finally:
+        if writer is not None:
+            stats.open -= 1
+            writer.close()
+
+
+async def run_load(links: List[Link], options: Dict[str, Any], context: ssl.SSLContext) -> Stats:
+    stats = Stats()
+    semaphore = asyncio.Semaphore(options['concurrency'])
+
+    async def one(i: int):
+        async with semaphore:
+            await drive(links[i % len(links)], options, context, stats)
+
+    await asyncio.gather(*(one(i) for i in range(options['connections'])))
+    return stats
+
+
+def report(stats: Stats, started: float, elapsed: float, cpu: Dict[str, Tuple[Optional[float], Optional[float]]],
+           options: Dict[str, Any]) -> Dict[str, Any]:
+    established = len(stats.setup_ms)
+    setup_window = (stats.last_setup - started) if stats.last_setup else 0.0
+    bulk_window = (stats.bulk_finished - stats.bulk_started) if stats.bulk_finished else 0.0
+    processes = {}
+    for name, (before, after) in cpu.items():
+        seconds = after - before if before is not None and after is not None else None
+        processes[name] = {
+            'cpu_seconds': seconds,
+            'cpu_percent': seconds / elapsed * 100 if seconds is not None and elapsed > 0 else None,
+        }
+    return {
+        'connections': options['connections'],
+        'established': established,
+        'failed': options['connections'] - established,
+        'errors': stats.errors,
+        'peak_open': stats.peak_open,
+        'seconds': elapsed,
+        'setup_per_second': established / setup_window if setup_window > 0 else 0.0,
+        'setup_ms': {p: percentile(stats.setup_ms, q) for p, q in (('p50', 50), ('p99', 99))},
+        'rtt_ms': {p: percentile(stats.rtt_ms, q) for p, q in (('p50', 50), ('p90', 90), ('p99', 99))},
+        'echoed_mib': stats.bytes / (1 << 20),
+        'throughput_mib_per_second': stats.bytes / (1 << 20) / bulk_window if bulk_window > 0 else 0.0,
+        'processes': processes,
+    }
+
+
+def print_report(result: Dict[str, Any]):
+    print(f"\nConnections: {result['established']}/{result['connections']} established "
+          f"(peak {result['peak_open']} open) in {result['seconds']:.2f}s")
+    if result['errors']:
+        print("Errors: " + ', '.join(f"{name} x{count}" for name, count in sorted(result['errors'].items())))
+    print(f"Setup:      {result['setup_per_second']:.0f}/s, "
+          f"p50 {result['setup_ms']['p50']:.1f} ms, p99 {result['setup_ms']['p99']:.1f} ms")
+    print(f"Round trip: p50 {result['rtt_ms']['p50']:.2f} ms, p90 {result['rtt_ms']['p90']:.2f} ms, "
+          f"p99 {result['rtt_ms']['p99']:.2f} ms")
+    print(f"Throughput: {result['throughput_mib_per_second']:.1f} MiB/s echoed "
+          f"({result['echoed_mib']:.1f} MiB)")
+    print("CPU:")
+    for name, usage in result['processes'].items():
+        if usage['cpu_seconds'] is None:
+            print(f"  {name:<10} n/a")
+        else:
+            print(f"  {name:<10} {usage['cpu_seconds']:7.2f}s  {usage['cpu_percent']:5.1f}%")
+
+
+def parse_overrides(pairs: List[str]) -> Dict[str, Any]:
+    overrides = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+
+def load_test(args: argparse.Namespace) -> Dict[str, Any]:
+    backend = args.backend
+    if backend == 'auto':
+        backend = 'real' if shutil.which('caddy') and shutil.which('xray') else 'standin'
+
+    with tempfile.TemporaryDirectory(prefix='gfwmass-loadtest-') as workdir:
+        os.chdir(workdir)
+        cert = os.path.join(workdir, 'fullchain.pem')
+        key = os.path.join(workdir, 'privkey.pem')
+        config: Dict[str, Any] = {
+            'domain': args.domain,
+            'origin_ip': '127.0.0.1',
+            'user_id': str(uuid.uuid4()),
+            'cloudflare': {'api_token': 'loadtest', 'zone_id': 'loadtest'},
+            'state_db': None,
+            'xray_api': False,
+            'xray_port': free_port(),
+            'xray_socket_dir': workdir,
+            'manual_cert_path': cert,
+            'manual_key_path': key,
+        }
+        overrides = parse_overrides(args.set)
+        config.update(overrides)
+        with open('config.json', 'w') as f:
+            json.dump(config, f)
+
+        gfw = GFWMass('config.json')
+        if len(gfw.xray_instances()) > 1 and config.get('xray_transport', 'tcp') == 'tcp':
+            # Worker ports are consecutive from xray_port
+            gfw.config['xray_port'] = free_port()
+        gfw.generate_subdomains(args.domains)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            gfw.save_configs()
+        make_certificate(workdir, [zone.domain for zone in gfw.zones()])
+        links = [parse_link(link) for link in
+                 base64.b64decode(gfw.generate_subscription()).decode().splitlines()]
+
+        options = {
+            'connections': args.connections,
+            'concurrency': args.concurrency or args.connections,
+            'pings': args.pings,
+            'ping_size': args.ping_size,
+            'bytes': args.bytes,
+            'timeout': args.timeout,
+            'caddy_port': free_port(),
+            'echo_port': free_port(),
+        }
+        print(f"Backend: {backend}; {len(gfw.xray_instances())} Xray worker(s) over "
+              f"{config.get('xray_transport', 'tcp')}; {len(links)} subscription links")
+        services = start_services(gfw, workdir, backend, options['caddy_port'], options['echo_port'], cert, key)
+        try:
+            context = ssl.create_default_context(cafile=cert)
+            pids = {service.name: service.process.pid for service in services}
+            pids['client'] = os.getpid()
+            before = {name: process_cpu(pid) for name, pid in pids.items()}
+            print(f"Driving {options['connections']} VLESS/WebSocket connections "
+                  f"({options['concurrency']} at a time, {options['pings']} pings, {options['bytes']} bytes each)...")
+            started = time.perf_counter()
+            stats = asyncio.run(run_load(links, options, context))
+            elapsed = time.perf_counter() - started
+            after = {name: process_cpu(pid) for name, pid in pids.items()}
+        finally:
+            stop_services(services)
+
+        result = report(stats, started, elapsed, {name: (before[name], after[name]) for name in pids}, options)
+        result['backend'] = backend
+        result['config'] = overrides
+        return result
+
+
+def compare_profiles(args: argparse.Namespace) -> Dict[str, Any]:
+    names: List[str] = []
+    for name in args.tuning_profile:
+        names.extend(['none'] + list(PROFILES) if name == 'all' else [name])
+    unknown = [name for name in names if name != 'none' and name not in PROFILES]
+    if unknown:
+        raise SystemExit(f"Unknown tuning profile(s): {', '.join(unknown)} (available: none, {', '.join(PROFILES)})")
+
+    # Same load, same overrides, one fresh chain per profile
+    results: Dict[str, Dict[str, Any]] = {}
+    for name in dict.fromkeys(names):
+        print(f"\n=== Profile: {name} ===\n")
+        run = argparse.Namespace(**vars(args))
+        run.set = args.set + ([f'tuning_profile="{name}"'] if name != 'none' else [])
+        results[name] = load_test(run)
+        print_report(results[name])
+
+    print(f"\n{'profile':<12} {'setup/s':>8} {'setup p99':>10} {'rtt p50':>8} {'rtt p99':>8} "
+          f"{'MiB/s':>7} {'failed':>7}  cpu s (per process)")
+    for name, result in results.items():
+        cpu = ' '.join(f"{process}={usage['cpu_seconds']:.2f}" for process, usage in result['processes'].items()
+                       if usage['cpu_seconds'] is not None)
+        print(f"{name:<12} {result['setup_per_second']:>8.0f} {result['setup_ms']['p99']:>10.1f} "
+              f"{result['rtt_ms']['p50']:>8.2f} {result['rtt_ms']['p99']:>8.2f} "
+              f"{result['throughput_mib_per_second']:>7.1f} {result['failed']:>7}  {cpu}")
+    return {'profiles': results}
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'standin':
+        standin_main(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description='GFWMass end-to-end load test (Caddy -> Xray on loopback)')
+    parser.add_argument('--connections', type=int, default=1000, help='Connections to open (default: 1000)')
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help='Connections in flight at once (default: all of them)')
+    parser.add_argument('--pings', type=int, default=10,
+                        help='Round trips per connection after setup, for latency (default: 10)')
+    parser.add_argument('--ping-size', type=int, default=64, help='Bytes per round trip (default: 64)')
+    parser.add_argument('--bytes', type=int, default=262144,
+                        help='Bytes echoed through each connection, for throughput (default: 262144)')
+    parser.add_argument('--domains', type=int, default=100,
+                        help='Subscription size; connections cycle through its links (default: 100)')
+    parser.add_argument('--domain', default='loadtest.example', help='Zone for the generated domains')
+    parser.add_argument('--timeout', type=float, default=30, help='Per-step timeout in seconds (default: 30)')
+    parser.add_argument('--backend', choices=['auto', 'real', 'standin'], default='auto',
+                        help='real: caddy and xray from PATH; standin: asyncio stand-ins (default: auto)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=JSON',
+                        help='Override a config.json key, e.g. --set workers=4 (repeatable)')
+    parser.add_argument('-o', '--output', help='Write the result as JSON to this file')
+    parser.add_argument('--tuning-profile', action='append', default=[], metavar='NAME',
+                        help=f"Run once per tuning profile and compare: none, {', '.join(PROFILES)} "
+                             "or all (repeatable)")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    output = os.path.abspath(args.output) if args.output else None
+    if args.tuning_profile:
+        result = compare_profiles(args)
+    else:
+        result = load_test(args)
+        print_report(result)
+
+    if output:
+        result['meta'] = {
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'options': vars(args),
+        }
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"\nResults written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Local stand-ins for the two runtime control planes gfwmass.py reloads
+# through, so the reload path can be exercised without Caddy or Xray:
+#
+#   python3 mock_admin.py caddy --port 2019
+#       Caddy admin API: accepts POST /load with a Caddyfile and serves the
+#       last one back from GET /config/. Point "caddy_admin" at it.
+#
+#   python3 mock_admin.py xray api <command> [args...]
+#       Stand-in for the "xray api" CLI: appends each call (and the content
+#       of any JSON file it names) to $MOCK_XRAY_LOG, default
+#       mock_xray_api.jsonl. Use "xray_bin": "python3 mock_admin.py xray".
+
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+import argparse
+
+
+class MockCaddyAdminHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server: 'MockCaddyAdminServer'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes = b'', content_type: str = 'application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.path.rstrip('/') != '/load':
+            return self._send(404, json.dumps({'error': 'not found'}).encode())
+        if self.headers.get('Content-Type', '').split(';')[0] != 'text/caddyfile':
+            return self._send(400, json.dumps({'error': 'unsupported Content-Type'}).encode())
+        if self.server.reject:
+            return self._send(400, json.dumps({'error': 'adapting config using caddyfile: rejected by mock'}).encode())
+        with self.server.lock:
+            self.server.loads.append(body)
+        self._send(200)
+
+    def do_GET(self):
+        if not self.path.startswith('/config'):
+            return self._send(404, json.dumps({'error': 'not found'}).encode())
+        with self.server.lock:
+            last = self.server.loads[-1] if self.server.loads else b''
+        self._send(200, last, 'text/caddyfile')
+
+
+class MockCaddyAdminServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, reject: bool = False):
+        super().__init__(address, MockCaddyAdminHandler)
+        self.reject = reject
+        self.loads: List[bytes] = []
+        self.lock = threading.Lock()
+
+
+class MockCaddyAdmin:
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, reject: bool = False):
+        self.server = MockCaddyAdminServer((host, port), reject)
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def loads(self) -> List[bytes]:
+        return self.server.loads
+
+    def start(self) -> 'MockCaddyAdmin':
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> 'MockCaddyAdmin':
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def record_xray_api(argv: List[str]) -> int:
+    # argv as "xray" would see it: ["api", <command>, --server=..., ...]
+    if len(argv) < 2 or argv[0] != 'api':
+        print("usage: mock_admin.py xray api <command> [args...]", file=sys.stderr)
+        return 2
+    if os.environ.get('MOCK_XRAY_FAIL'):
+        print("failed to dial: connection refused", file=sys.stderr)
+        return 1
+
+    call = {'time': time.time(), 'command': argv[1], 'args': argv[2:], 'files': {}}
+    for arg in argv[2:]:
+        if arg.endswith('.json') and os.path.exists(arg):
+            with open(arg) as f:
+                call['files'][arg] = json.load(f)
+    with open(os.environ.get('MOCK_XRAY_LOG', 'mock_xray_api.jsonl'), 'a') as f:
+        f.write(json.dumps(call) + '\n')
+    return 0
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'xray':
+        sys.exit(record_xray_api(sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description='Mock Caddy admin API (and xray api CLI) for local testing')
+    parser.add_argument('service', choices=['caddy'], help='Control plane to mock ("xray api ..." is handled separately)')
+    parser.add_argument('--host', default='127.0.0.1', help='Bind address (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=2019, help='Listen port (default: 2019)')
+    parser.add_argument('--reject', action='store_true', help='Answer every /load with 400')
+    args = parser.parse_args()
+
+    mock = MockCaddyAdmin(args.host, args.port, reject=args.reject)
+    print(f"Mock Caddy admin API listening on {mock.url}", flush=True)
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
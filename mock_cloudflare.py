@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the subset of the Cloudflare v4 DNS records API that
+# gfwmass.py uses. Point "cloudflare.api_base" in config.json at
+#   http://127.0.0.1:<port>/client/v4
+# to exercise provisioning without touching a real zone.
+
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+import argparse
+
+
+RECORDS_PATH = re.compile(r'^/client/v4/zones/([^/]+)/dns_records(?:/([^/]+))?/?$')
+
+
+class MockCloudflareState:
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0,
+                 retry_after: float = 1.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.zones: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        # (type, name, content) -> record id per zone, for duplicate checks
+        self.keys: Dict[str, Dict[Tuple[str, str, str], str]] = {}
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.rate_limited_count = 0
+
+    def zone(self, zone_id: str) -> Dict[str, Dict[str, Any]]:
+        self.keys.setdefault(zone_id, {})
+        return self.zones.setdefault(zone_id, {})
+
+    def should_rate_limit(self) -> bool:
+        with self.lock:
+            self.request_count += 1
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.rate_limited_count += 1
+                return True
+        return False
+
+    @staticmethod
+    def _key(record: Dict[str, Any]) -> Tuple[str, str, str]:
+        return record.get('type', 'A'), record.get('name', ''), record.get('content', '')
+
+    def _put(self, zone_id: str, record: Dict[str, Any], undo: Optional[list]):
+        records, keys = self.zone(zone_id), self.keys[zone_id]
+        previous = records.get(record['id'])
+        if previous is not None:
+            keys.pop(self._key(previous), None)
+        records[record['id']] = record
+        keys[self._key(record)] = record['id']
+        if undo is not None:
+            undo.append((record['id'], previous))
+
+    def _remove(self, zone_id: str, record_id: str, undo: Optional[list]):
+        records, keys = self.zone(zone_id), self.keys[zone_id]
+        previous = records.pop(record_id)
+        keys.pop(self._key(previous), None)
+        if undo is not None:
+            undo.append((record_id, previous))
+
+    def _rollback(self, zone_id: str, undo: list):
+        for record_id, previous in reversed(undo):
+            if record_id in self.zone(zone_id):
+                self._remove(zone_id, record_id, None)
+            if previous is not None:
+                self._put(zone_id, previous, None)
+
+    def _create(self, zone_id: str, data: Dict[str, Any], undo: Optional[list] = None):
+        if self._key(data) in self.keys[zone_id]:
+            return 400, None, [{'code': 81058, 'message': 'An identical record already exists.'}]
+        record = {
+            'id': uuid.uuid4().hex,
+            'zone_id': zone_id,
+            'type': data.get('type', 'A'),
+            'name': data.get('name', ''),
+            'content': data.get('content', ''),
+            'ttl': data.get('ttl', 1),
+            'proxied': data.get('proxied', False),
+            'comment': data.get('comment'),
+            'created_on': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        }
+        self._put(zone_id, record, undo)
+        return 200, record, []
+
+    def _delete(self, zone_id: str, record_id: str, undo: Optional[list] = None):
+        if record_id not in self.zone(zone_id):
+            return 404, None, [{'code': 81044, 'message': 'Record does not exist.'}]
+        self._remove(zone_id, record_id, undo)
+        return 200, {'id': record_id}, []
+
+    def _patch(self, zone_id: str, record_id: str, data: Dict[str, Any], undo: Optional[list] = None):
+        record = self.zone(zone_id).get(record_id)
+        if record is None:
+            return 404, None, [{'code': 81044, 'message': 'Record does not exist.'}]
+        record = dict(record)
+        record.update({k: v for k, v in data.items() if k in ('type', 'name', 'content', 'ttl', 'proxied', 'comment')})
+        self._put(zone_id, record, undo)
+        return 200, record, []
+
+    def create(self, zone_id: str, data: Dict[str, Any]):
+        with self.lock:
+            self.zone(zone_id)
+            return self._create(zone_id, data)
+
+    def delete(self, zone_id: str, record_id: str):
+        with self.lock:
+            return self._delete(zone_id, record_id)
+
+    def patch(self, zone_id: str, record_id: str, data: Dict[str, Any]):
+        with self.lock:
+            return self._patch(zone_id, record_id, data)
+
+    def batch(self, zone_id: str, data: Dict[str, Any]):
+        # Like the real endpoint, a batch is applied atomically: deletes,
+        # patches then posts, and any failure rolls the whole batch back
+        with self.lock:
+            self.zone(zone_id)
+            undo: list = []
+            result: Dict[str, list] = {'deletes': [], 'patches': [], 'posts': []}
+            steps = (
+                ('deletes', lambda item: self._delete(zone_id, item.get('id', ''), undo)),
+                ('patches', lambda item: self._patch(zone_id, item.get('id', ''), item, undo)),
+                ('posts', lambda item: self._create(zone_id, item, undo)),
+            )
+            for key, apply in steps:
+                for item in data.get(key) or []:
+                    status, record, errors = apply(item)
+                    if status != 200:
+                        self._rollback(zone_id, undo)
+                        return 400, None, errors
+                    result[key].append(record)
+        return 200, result, []
+
+    def list(self, zone_id: str, params: Dict[str, str]):
+        with self.lock:
+            records = list(self.zone(zone_id).values())
+        if 'type' in params:
+            records = [r for r in records if r['type'] == params['type']]
+        if 'name' in params:
+            records = [r for r in records if r['name'] == params['name']]
+        if 'content' in params:
+            records = [r for r in records if r['content'] == params['content']]
+
+        per_page = max(1, min(5000, int(params.get('per_page', 100))))
+        page = max(1, int(params.get('page', 1)))
+        total = len(records)
+        result = records[(page - 1) * per_page:page * per_page]
+        info = {
+            'page': page,
+            'per_page': per_page,
+            'count': len(result),
+            'total_count': total,
+            'total_pages': max(1, -(-total // per_page)),
+        }
+        return 200, result, [], info
+
+
+class MockCloudflareHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server: 'MockCloudflareServer'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, result=None, errors=None, result_info=None, headers=None):
+        body = {
+            'success': 200 <= status < 300,
+            'errors': errors or [],
+            'messages': [],
+            'result': result,
+        }
+        if result_info is not None:
+            body['result_info'] = result_info
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_json(self) -> Any:
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length))
+
+    def _dispatch(self, method: str):
+        state = self.server.state
+        url = urlparse(self.path)
+        body = self._read_json() if method in ('POST', 'PUT', 'PATCH') else None
+
+        if state.latency:
+            time.sleep(state.latency)
+
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self._send(403, errors=[{'code': 10000, 'message': 'Authentication error'}])
+
+        if state.should_rate_limit():
+            return self._send(
+                429,
+                errors=[{'code': 10013, 'message': 'Rate limited. Please wait and consider throttling your request speed'}],
+                headers={'Retry-After': f'{state.retry_after:g}'},
+            )
+
+        match = RECORDS_PATH.match(url.path)
+        if not match:
+            return self._send(404, errors=[{'code': 7000, 'message': 'No route for that URI'}])
+        zone_id, record_id = match.groups()
+
+        if method == 'GET' and record_id is None:
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            status, result, errors, info = state.list(zone_id, params)
+            return self._send(status, result, errors, info)
+        if method == 'POST' and record_id is None:
+            return self._send(*state.create(zone_id, body or {}))
+        if method == 'POST' and record_id == 'batch':
+            return self._send(*state.batch(zone_id, body or {}))
+        if method == 'DELETE' and record_id is not None:
+            return self._send(*state.delete(zone_id, record_id))
+        if method == 'PATCH' and record_id is not None:
+            return self._send(*state.patch(zone_id, record_id, body or {}))
+
+        return self._send(405, errors=[{'code': 10405, 'message': 'Method not allowed'}])
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+
+class MockCloudflareServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, state: MockCloudflareState):
+        super().__init__(address, MockCloudflareHandler)
+        self.state = state
+
+
+class MockCloudflare:
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, **state_options):
+        self.state = MockCloudflareState(**state_options)
+        self.server = MockCloudflareServer((host, port), self.state)
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def api_base(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/client/v4"
+
+    def start(self) -> 'MockCloudflare':
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> 'MockCloudflare':
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock Cloudflare v4 DNS API for local testing')
+    parser.add_argument('--host', default='127.0.0.1', help='Bind address (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8787, help='Listen port (default: 8787)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds of artificial latency per request (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests answered with 429 (default: 0)')
+    parser.add_argument('--retry-after', type=float, default=1.0,
+                        help='Retry-After seconds sent with 429 responses (default: 1)')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for 429 injection')
+    args = parser.parse_args()
+
+    mock = MockCloudflare(args.host, args.port, latency=args.latency,
+                          error_rate=args.error_rate, retry_after=args.retry_after,
+                          seed=args.seed)
+    print(f"Mock Cloudflare API listening on {mock.api_base}", flush=True)
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.server.server_close()
+
+
+if __name__ == '__main__':
+    main()